@@ -4,6 +4,13 @@ __all__ = [
     "lang",
     "default",
     "lineest",
+    "nlbin",
+    "gpageseg",
+    "rpred",
+    "packed",
+    "linebundle",
+    "pfilters",
+    "rserver",
 ]
 
 ################################################################
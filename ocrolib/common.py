@@ -6,6 +6,7 @@
 import os
 import os.path
 import re
+import subprocess
 import sys
 import sysconfig
 import unicodedata
@@ -15,6 +16,7 @@ import pickle
 import numpy as np
 import gzip
 from ocrolib.exceptions import (BadClassLabel, BadInput, FileNotFound, OcropusException)
+from ocrolib import pfilters
 
 import numpy
 from numpy import amax, amin, array, bitwise_and, clip, dtype, mean, minimum, nan, sin, sqrt, zeros
@@ -28,11 +30,13 @@ from toplevel import (checks, desc, ABINARY2, AINT2, AINT3, BOOL, DARKSEG, GRAYS
                       LIGHTSEG, LINESEG, PAGESEG)
 import chars
 import codecs
+import collections
 import ligatures
 import lstm
 import morph
 import multiprocessing
 import sl
+from ocrolib.packed import PackedBinary
 
 pickle_mode = 2
 
@@ -153,16 +157,145 @@ def isintarray(a):
 def isintegerarray(a):
     return a.dtype in [dtype('int32'),dtype('int64'),dtype('uint32'),dtype('uint64')]
 
-@checks(str,pageno=int,_=GRAYSCALE)
-def read_image_gray(fname, pageno=0):
-    """Read an image and returns it as a floating point array.
-    The optional page number allows images from files containing multiple
-    images to be addressed.  Byte and short arrays are rescaled to
-    the range 0...1 (unsigned) or -1...1 (signed)."""
-    if type(fname)==tuple:
-        fname, pageno = fname
-    assert pageno==0
+################################################################
+### Multi-page images
+################################################################
+
+def is_pdf(fname):
+    """Check whether a file is a PDF file (by its name)."""
+    return fname.lower().endswith(".pdf")
+
+def read_pnm(stream):
+    """Read one binary PGM or PPM image (P5 or P6, 8 bit) from a stream and
+    return it as a PIL image, or return None at the end of the stream.
+    Streams may contain any number of concatenated images."""
+    def token():
+        result = b""
+        while True:
+            c = stream.read(1)
+            if c==b"": break
+            if c==b"#":
+                while c not in [b"\n", b""]: c = stream.read(1)
+                continue
+            if c.isspace():
+                if result!=b"": break
+                continue
+            result += c
+        return result
+    magic = token()
+    if magic==b"": return None
+    if magic not in [b"P5", b"P6"]:
+        raise BadInput("unsupported image stream %r" % magic)
+    w, h, maxval = int(token()), int(token()), int(token())
+    if maxval>255:
+        raise BadInput("only 8 bit image streams are supported")
+    mode, depth = ("L", 1) if magic==b"P5" else ("RGB", 3)
+    data = stream.read(w*h*depth)
+    if len(data)<w*h*depth:
+        raise BadInput("truncated image stream")
+    return PIL.Image.frombytes(mode, (w, h), data)
+
+def pdf_pages(fname,resolution=300,first=None,last=None):
+    """Rasterize the pages of a PDF file (from page `first` to page `last`,
+    counting from 0) and iterate over them as grayscale PIL images.  This
+    runs Ghostscript and reads its output as a stream of PGM images, so only
+    one page is in memory at a time and no temporary files are written."""
+    cmd = ["gs", "-q", "-dSAFER", "-dBATCH", "-dNOPAUSE", "-sDEVICE=pgmraw",
+           "-r%d" % resolution, "-dTextAlphaBits=4", "-dGraphicsAlphaBits=4"]
+    if first is not None: cmd += ["-dFirstPage=%d" % (first+1)]
+    if last is not None: cmd += ["-dLastPage=%d" % (last+1)]
+    cmd += ["-sOutputFile=-", fname]
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except OSError:
+        raise FileNotFound("gs (Ghostscript is needed to read PDF files)")
+    try:
+        while True:
+            page = read_pnm(p.stdout)
+            if page is None: break
+            yield page
+    finally:
+        # also reached when the caller stops early; gs then exits on the closed pipe
+        p.stdout.close()
+        p.wait()
+    if p.returncode!=0:
+        raise BadInput("gs failed on %s" % fname)
+
+def pdf_page_count(fname):
+    """The number of pages of a PDF file, as counted by Ghostscript (without
+    rasterizing any of them).  Ghostscript runs in safe mode, allowed to
+    read only that file."""
+    path = fname.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+    cmd = ["gs", "-q", "-dNODISPLAY", "-dSAFER", "--permit-file-read=%s" % fname,
+           "-dBATCH", "-dNOPAUSE", "-c", "(%s) (r) file runpdfbegin pdfpagecount = quit" % path]
+    try:
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    except OSError:
+        raise FileNotFound("gs (Ghostscript is needed to read PDF files)")
+    output = p.communicate()[0].split()
+    if p.returncode!=0 or len(output)<1 or not output[-1].isdigit():
+        raise BadInput("gs cannot count the pages of %s" % fname)
+    return int(output[-1])
+
+def page_count(fname):
+    """The number of pages of an image file (see `image_pages`)."""
+    if is_pdf(fname): return pdf_page_count(fname)
+    return getattr(PIL.Image.open(fname), "n_frames", 1)
+
+def page_runs(pages):
+    """Split a sorted list of page numbers into `(first, last)` runs of
+    consecutive pages."""
+    runs = []
+    for pageno in pages:
+        if runs and runs[-1][1]==pageno-1:
+            runs[-1][1] = pageno
+        else:
+            runs.append([pageno, pageno])
+    return [tuple(run) for run in runs]
+
+def image_pages(fname,resolution=300,pages=None):
+    """Iterate over the pages of an image file as PIL images (each one is
+    only valid until the next one is requested).  This handles multi-page
+    files (TIFF, GIF, ...) as well as PDF files, which are rasterized with
+    the given resolution; other files have a single page.  If `pages` (a
+    sorted list of page numbers, counting from 0) is given, only those pages
+    are read; PDF files are then rasterized in runs of consecutive pages."""
+    if is_pdf(fname):
+        if pages is None:
+            for page in pdf_pages(fname,resolution):
+                yield page
+            return
+        for first, last in page_runs(pages):
+            for page in pdf_pages(fname,resolution,first=first,last=last):
+                yield page
+        return
+    pil = PIL.Image.open(fname)
+    for pageno in (range(getattr(pil, "n_frames", 1)) if pages is None else pages):
+        pil.seek(pageno)
+        yield pil
+
+def open_page(fname,pageno=0,resolution=300):
+    """Open the given page of an image file as a PIL image."""
+    if is_pdf(fname):
+        for page in pdf_pages(fname,resolution,first=pageno,last=pageno):
+            return page
+        raise BadInput("%s has no page %d" % (fname, pageno))
     pil = PIL.Image.open(fname)
+    if pageno>0:
+        try:
+            pil.seek(pageno)
+        except EOFError:
+            raise BadInput("%s has no page %d" % (fname, pageno))
+    return pil
+
+def is_multipage(fname):
+    """Check whether a file may contain more than one page image."""
+    if is_pdf(fname): return True
+    return getattr(PIL.Image.open(fname), "n_frames", 1)>1
+
+def pil2gray(pil):
+    """Convert a PIL image to a floating point array.  Byte and short arrays
+    are rescaled to the range 0...1 (unsigned) or -1...1 (signed)."""
     a = pil2array(pil)
     if a.dtype==dtype('uint8'):
         a = a/255.0
@@ -180,6 +313,49 @@ def read_image_gray(fname, pageno=0):
         a = mean(a,2)
     return a
 
+def pil2binary(pil,dtype='i'):
+    """Convert a PIL image to a binary array of the given dtype."""
+    a = pil2array(pil)
+    if a.ndim==3:
+        a = amax(a,axis=2)
+    return array(a>0.5*(float(amin(a))+float(amax(a))),dtype)
+
+@checks({str,tuple},pageno=int,_=GRAYSCALE)
+def read_image_gray(fname, pageno=0):
+    """Read an image and returns it as a floating point array.
+    The optional page number allows images from files containing multiple
+    images (multi-page TIFF files, PDF files) to be addressed; `fname` may
+    also be a `(fname, pageno)` tuple.  Byte and short arrays are rescaled to
+    the range 0...1 (unsigned) or -1...1 (signed)."""
+    if type(fname)==tuple:
+        fname, pageno = fname
+    return pil2gray(open_page(fname, pageno))
+
+def numbered_pages(fname,pages=None):
+    """Iterate over `(pageno, pil)` for the pages of `image_pages`."""
+    if pages is None:
+        return enumerate(image_pages(fname))
+    return zip(pages, image_pages(fname,pages=pages))
+
+def read_pages_gray(fname,pages=None):
+    """Iterate over `(pageno, image)` for all the pages of an image file
+    (or the given ones, see `image_pages`), as floating point arrays (see
+    `read_image_gray`).  Only one page is read into memory at a time."""
+    for pageno, pil in numbered_pages(fname,pages):
+        yield pageno, pil2gray(pil)
+
+def read_pages_binary(fname,dtype='i',pages=None):
+    """Iterate over `(pageno, image)` for all the pages of an image file
+    (or the given ones), as binary arrays (see `read_image_binary`)."""
+    for pageno, pil in numbered_pages(fname,pages):
+        yield pageno, pil2binary(pil, dtype)
+
+def read_pages_packed(fname,pages=None):
+    """Iterate over `(pageno, image)` for all the pages of an image file
+    (or the given ones), as packed binary images (see `read_image_packed`)."""
+    for pageno, pil in numbered_pages(fname,pages):
+        yield pageno, PackedBinary.from_pil(pil)
+
 
 def write_image_gray(fname,image,normalize=0,verbose=0):
     """Write an image to disk.  If the image is of floating point
@@ -193,24 +369,39 @@ def write_image_gray(fname,image,normalize=0,verbose=0):
     im = array2pil(image)
     im.save(fname)
 
-@checks(str,_=ABINARY2)
+@checks({str,tuple},_=ABINARY2)
 def read_image_binary(fname,dtype='i',pageno=0):
     """Read an image from disk and return it as a binary image
-    of the given dtype."""
+    of the given dtype.  Pages are addressed as for `read_image_gray`."""
     if type(fname)==tuple:
         fname, pageno = fname
-    assert pageno==0
-    pil = PIL.Image.open(fname)
-    a = pil2array(pil)
-    if a.ndim==3:
-        a = amax(a,axis=2)
-    return array(a>0.5*(amin(a)+amax(a)),dtype)
+    return pil2binary(open_page(fname, pageno), dtype)
+
+def read_image_packed(fname,pageno=0):
+    """Read an image from disk and return it as a PackedBinary, thresholded as
+    by `read_image_binary` but without creating a dense array.  Pages are
+    addressed as for `read_image_gray`."""
+    if type(fname)==tuple:
+        fname, pageno = fname
+    return PackedBinary.from_pil(open_page(fname, pageno))
 
-@checks(str,ABINARY2)
 def write_image_binary(fname,image,verbose=0):
     """Write a binary image to disk. This verifies first that the given image
     is, in fact, binary.  The image may be of any type, but must consist of only
-    two values."""
+    two values.  It may also be a PackedBinary, which is written without
+    unpacking it."""
+    if isinstance(image,PackedBinary):
+        if verbose: print("# writing", fname)
+        if image.count() in (0,image.shape[0]*image.shape[1]):
+            # like a constant dense image, written as all zeros
+            image = PackedBinary(zeros(image.bits.shape,'B'),image.shape)
+        image.to_pil().convert("L").save(fname)
+        return
+    write_array_binary(fname,image,verbose)
+
+@checks(str,ABINARY2)
+def write_array_binary(fname,image,verbose=0):
+    """Write a dense binary array to disk (see `write_image_binary`)."""
     if verbose: print("# writing", fname)
     assert image.ndim==2
     image = array(255*(image>midrange(image)),'B')
@@ -566,6 +757,12 @@ def number_of_processors():
     return multiprocessing.cpu_count()
     # return int(os.popen("cat /proc/cpuinfo  | grep 'processor.*:' | wc -l").read())
 
+def worker_pool(parallel):
+    """A pool of `parallel` processes, which share the processors among their
+    filtering threads (see ocrolib.pfilters)."""
+    threads = max(1, pfilters.threads//parallel)
+    return multiprocessing.Pool(parallel, pfilters.set_threads, (threads,))
+
 def parallel_map(fun,jobs,parallel=0,chunksize=1):
     if parallel<2:
         for e in jobs:
@@ -573,7 +770,7 @@ def parallel_map(fun,jobs,parallel=0,chunksize=1):
             yield result
     else:
         try:
-            pool = multiprocessing.Pool(parallel)
+            pool = worker_pool(parallel)
             for e in pool.imap_unordered(fun,jobs,chunksize):
                 yield e
         finally:
@@ -581,6 +778,33 @@ def parallel_map(fun,jobs,parallel=0,chunksize=1):
             pool.join()
             del pool
 
+def imap_jobs(fun,jobs,parallel=0,maxpending=None):
+    """Apply `fun` to the jobs (in `parallel` processes if `parallel>1`)
+    and iterate over the `(job, result)` pairs, in the order of the jobs.
+    Unlike `pool.imap`, this consumes `jobs` (which may be a generator) only
+    as results are taken, keeping at most `maxpending` (default: twice the
+    number of processes) jobs in flight, so that jobs that carry large data,
+    like the pages of a multi-page image file, are never all in memory."""
+    if parallel<2:
+        for job in jobs:
+            yield job, fun(job)
+        return
+    if maxpending is None: maxpending = 2*parallel
+    pool = worker_pool(parallel)
+    try:
+        pending = collections.deque()
+        for job in jobs:
+            pending.append((job, pool.apply_async(fun, (job,))))
+            if len(pending)>=maxpending:
+                job, result = pending.popleft()
+                yield job, result.get()
+        while len(pending)>0:
+            job, result = pending.popleft()
+            yield job, result.get()
+    finally:
+        pool.close()
+        pool.join()
+
 def check_valid_class_label(s):
     """Determines whether the given character is a valid class label.
     Control characters and spaces are not permitted."""
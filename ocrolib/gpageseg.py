@@ -0,0 +1,534 @@
+################################################################
+### Page segmentation into text lines (the algorithm behind
+### ocropus-gpageseg).
+###
+### All functions take their parameters explicitly and work on
+### arrays, so binarized pages can be segmented in-process:
+###
+###     segmentation, lines, scale = gpageseg.segment(binary)
+################################################################
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.ndimage import measurements
+from ocrolib.pfilters import gaussian_filter, uniform_filter, maximum_filter
+
+from toplevel import *
+import sl, morph, psegutils
+from ocrolib.exceptions import BadImage
+from ocrolib.packed import PackedBinary
+
+
+def find(condition):
+    "Return the indices where ravel(condition) is true"
+    res, = np.nonzero(np.ravel(condition))
+    return res
+
+
+def B(a):
+    if a.dtype==np.dtype('B'): return a
+    return np.array(a,'B')
+
+
+def DSAVE(debug,title,image):
+    """Save an intermediate image as _<title>.png if debug is set."""
+    if not debug: return
+    from scipy.misc import imsave
+    if type(image)==list:
+        assert len(image)==3
+        image = np.transpose(np.array(image),[1,2,0])
+    fname = "_"+title+".png"
+    print("INFO: ", "debug " + fname)
+    imsave(fname,image.astype('float'))
+
+
+def check_page(image,components=None):
+    """Check whether the (inverted) binary image looks like a page image.
+    Returns None if it does and an explanation otherwise.  `components` is
+    the morph.ComponentIndex of the image, if it is already known."""
+    if len(image.shape)==3:
+        return "input image is color image %s"%(image.shape,)
+    if isinstance(image, PackedBinary):
+        # the median of a binary image is its majority value, so the mean is
+        # below the median if most but not all of the pixels are 1
+        ones, size = image.count(), image.shape[0]*image.shape[1]
+        if size < 2*ones < 2*size:
+            return "image may be inverted"
+    elif np.mean(image) < np.median(image):
+        return "image may be inverted"
+    h, w = image.shape
+    if h<600:
+        return "image not tall enough for a page image %s"%(image.shape,)
+    if h>10000:
+        return "image too tall for a page image %s"%(image.shape,)
+    if w<600:
+        return "image too narrow for a page image %s"%(image.shape,)
+    if w>10000:
+        return "line too wide for a page image %s"%(image.shape,)
+    slots = int(w*h*1.0/(30*30))
+    if components is not None:
+        ncomps = components.n
+    else:
+        image = np.asarray(image)
+        _,ncomps = measurements.label(image>np.mean(image))
+    if ncomps<10:
+        return "too few connected components for a page image (got %d)"%(ncomps,)
+    if ncomps>slots:
+        return "too many connnected components for a page image (%d > %d)"%(ncomps,slots)
+    return None
+
+
+################################################################
+### Column finding.
+###
+### This attempts to find column separators, either as extended
+### vertical black lines or extended vertical whitespace.
+### It will work fairly well in simple cases, but for unusual
+### documents, you need to tune the parameters or use a mask.
+################################################################
+
+def compute_separators_morph(binary,scale,sepwiden=10,maxseps=2):
+    """Finds vertical black lines corresponding to column separators."""
+    d0 = int(max(5,scale/4))
+    d1 = int(max(5,scale))+sepwiden
+    thick = morph.r_dilation(binary,(d0,d1))
+    vert = morph.rb_opening(thick,(10*scale,1))
+    vert = morph.r_erosion(vert, (d0//2,sepwiden))
+    vert = morph.select_regions(vert, sl.dim1, min=3,nbest=2*maxseps)
+    vert = morph.select_regions(vert, sl.dim0, min=20*scale,nbest=maxseps)
+    return vert
+
+
+def compute_colseps_morph(binary,scale,maxcolseps=3,csminheight=10,csminaspect=1.1):
+    """Finds extended vertical whitespace corresponding to column separators
+    using morphological operations."""
+    boxmap = psegutils.compute_boxmap(binary,scale,dtype='B')
+    bounds = morph.rb_closing(B(boxmap),(int(5*scale),int(5*scale)))
+    bounds = np.maximum(B(1-bounds),B(boxmap))
+    cols = 1-morph.rb_closing(boxmap,(int(20*scale),int(scale)))
+    cols = morph.select_regions(cols,sl.aspect,min=csminaspect)
+    cols = morph.select_regions(cols,sl.dim0,min=csminheight*scale,nbest=maxcolseps)
+    cols = morph.r_erosion(cols,(int(0.5+scale),0))
+    cols = morph.r_dilation(cols,(int(0.5+scale),0),origin=(int(scale/2)-1,0))
+    return cols
+
+
+def compute_colseps_mconv(binary,scale=1.0,maxcolseps=3,csminheight=10,debug=False):
+    """Find column separators using a combination of morphological
+    operations and convolution."""
+    h,w = binary.shape
+    smoothed = gaussian_filter(1.0*binary,(scale,scale*0.5))
+    smoothed = uniform_filter(smoothed,(5.0*scale,1))
+    thresh = (smoothed<np.amax(smoothed)*0.1)
+    DSAVE(debug,"1thresh",thresh)
+    blocks = morph.rb_closing(binary,(int(4*scale),int(4*scale)))
+    DSAVE(debug,"2blocks",blocks)
+    seps = np.minimum(blocks, thresh)
+    seps = morph.select_regions(seps,sl.dim0,min=csminheight*scale,nbest=maxcolseps)
+    DSAVE(debug,"3seps",seps)
+    blocks = morph.r_dilation(blocks,(5,5))
+    DSAVE(debug,"4blocks",blocks)
+    seps = np.maximum(seps,1-blocks)
+    DSAVE(debug,"5combo",seps)
+    return seps
+
+
+def colsep_candidates(binary,scale=1.0,debug=False):
+    """Find the candidates for column separators by convolution and thresholding
+    (see compute_colseps_conv)."""
+    h, w = binary.shape
+    # find vertical whitespace by thresholding
+    smoothed = gaussian_filter(1.0*binary, (scale,scale*0.5))
+    smoothed = uniform_filter(smoothed, (5.0*scale,1))
+    thresh = (smoothed < np.amax(smoothed)*0.1)
+    DSAVE(debug,"1thresh",thresh)
+    # find column edges by filtering
+    grad = gaussian_filter(1.0*binary, (scale,scale*0.5), order=(0,1))
+    grad = uniform_filter(grad, (10.0*scale,1))
+    # grad = abs(grad) # use this for finding both edges
+    grad = (grad>0.5*np.amax(grad))
+    DSAVE(debug,"2grad",grad)
+    # combine edges and whitespace
+    seps = np.minimum(thresh, maximum_filter(grad,(int(scale),int(5*scale))))
+    seps = maximum_filter(seps, (int(2*scale),1))
+    DSAVE(debug,"3seps",seps)
+    return seps
+
+
+def select_colseps(candidates,scale=1.0,maxcolseps=3,csminheight=10,debug=False):
+    """Select the biggest column separators among the candidates."""
+    seps = morph.select_regions(candidates,sl.dim0,min=csminheight*scale,nbest=maxcolseps)
+    DSAVE(debug,"4seps",seps)
+    return seps
+
+
+def compute_colseps_conv(binary,scale=1.0,maxcolseps=3,csminheight=10,debug=False):
+    """Find column separators by convolution and thresholding."""
+    seps = colsep_candidates(binary,scale,debug)
+    return select_colseps(seps,scale,maxcolseps,csminheight,debug)
+
+
+def compute_colseps(binary,scale,maxcolseps=3,maxseps=0,sepwiden=10,csminheight=10,
+                    mask=None,debug=False):
+    """Computes column separators either from vertical black lines or whitespace.
+    Returns the separators and the binary image with the separators (and the
+    optional mask) removed."""
+    colseps = compute_colseps_conv(binary,scale,maxcolseps,csminheight,debug)
+    DSAVE(debug,"colwsseps",0.7*colseps+0.3*binary)
+    if maxseps > 0:
+        seps = compute_separators_morph(binary,scale,sepwiden,maxseps)
+        DSAVE(debug,"colseps", 0.7*seps+0.3*binary)
+        colseps = np.maximum(colseps, seps)
+        binary = np.minimum(binary, 1 - seps)
+    if mask is not None:
+        binary, colseps = apply_mask(binary, colseps, mask, debug)
+    return colseps, binary
+
+
+def apply_mask(binary,colseps,mask,debug=False):
+    """Treat the (nonzero pixels of the) mask as additional column separators."""
+    masked_seps = np.maximum(colseps,mask)
+    binary = np.minimum(binary,1-masked_seps)
+    DSAVE(debug,"masked_seps", masked_seps)
+    return binary,masked_seps
+
+
+################################################################
+### Text Line Finding.
+###
+### This identifies the tops and bottoms of text lines by
+### computing gradients and performing some adaptive thresholding.
+### Those components are then used as seeds for the text lines.
+################################################################
+
+def compute_gradmaps(binary,scale,usegauss=False,vscale=1.0,hscale=1.0,debug=False,
+                     components=None):
+    # use gradient filtering to find baselines
+    boxmap = psegutils.compute_boxmap(binary, scale, components=components)
+    cleaned = boxmap*binary
+    DSAVE(debug,"cleaned",cleaned)
+    if usegauss:
+        # this uses Gaussians
+        grad = gaussian_filter(1.0*cleaned,(vscale*0.3*scale,
+                                            hscale*6*scale),order=(1,0))
+    else:
+        # this uses non-Gaussian oriented filters
+        grad = gaussian_filter(1.0*cleaned,(max(4,vscale*0.3*scale),
+                                            hscale*scale),order=(1,0))
+        grad = uniform_filter(grad,(vscale,hscale*6*scale))
+    bottom = norm_max((grad<0)*(-grad))
+    top = norm_max((grad>0)*grad)
+    return bottom,top,boxmap
+
+
+def norm_max(v):
+    return v/np.amax(v)
+
+
+def seed_spans(bmarked,tmarked,delta,maxgap):
+    """Given baseline (bmarked) and xheight (tmarked) candidates, mark in
+    each column the `delta` pixels above every baseline candidate, and the
+    pixels between a baseline candidate and the closest candidate above it
+    if that is an xheight candidate (or the top of the page) less than
+    `maxgap` pixels away.  All columns are processed at once: the spans are
+    accumulated as +1/-1 entries in a difference array."""
+    bmarked = (bmarked!=0)
+    tmarked = (tmarked!=0)
+    h, w = bmarked.shape
+    # the closest marked row above each row, -1 if there is none
+    rows = np.where(bmarked|tmarked, np.arange(h,dtype='i')[:,np.newaxis], np.int32(-1))
+    above = np.maximum.accumulate(rows, axis=0)
+    above = np.vstack([np.full((1,w),-1,'i'), above[:-1]])
+    y0, x = np.nonzero(bmarked)
+    y1 = above[y0, x]
+    # fill towards the candidate above unless there is an xheight candidate
+    # in the same row or the candidate above is a baseline candidate
+    fill = ~tmarked[y0, x] & ((y1<0) | ~bmarked[np.maximum(y1,0), x])
+    y1 = np.maximum(y1, 0)
+    fill &= (y0-y1)<maxgap
+    band = (y0>=delta)
+    # within each of these index sets, the positions are distinct
+    counts = np.zeros((h+1,w),'i')
+    counts[y0[band]-delta, x[band]] += 1
+    counts[y0[band], x[band]] -= 1
+    counts[y1[fill], x[fill]] += 1
+    counts[y0[fill], x[fill]] -= 1
+    return np.array(np.cumsum(counts,axis=0,dtype='i')[:h]>0,'i')
+
+
+def line_peaks(bottom,top,scale,vscale=1.0):
+    """The local maxima of the gradient maps over vertical ranges of vscale*scale
+    pixels, the candidates for baselines and xheights (see compute_line_seeds)."""
+    vrange = int(vscale*scale)
+    bpeaks = maximum_filter(bottom==maximum_filter(bottom, (vrange,0)), (2,2))
+    tpeaks = maximum_filter(top==maximum_filter(top,(vrange,0)),(2,2))
+    return bpeaks, tpeaks
+
+
+def compute_line_seeds(binary,bottom,top,colseps,scale,threshold=0.2,vscale=1.0,debug=False,
+                       peaks=None):
+    """Base on gradient maps, computes candidates for baselines and xheights.  Then, it marks the
+       regions between the two as a line seed.  `peaks` are the line_peaks of the gradient maps,
+       if they are already known.
+    """
+    t = threshold
+    if peaks is None:
+        peaks = line_peaks(bottom,top,scale,vscale)
+    bmarked, tmarked = peaks
+    bmarked = bmarked*(bottom>t*np.amax(bottom)*t)*(1-colseps)
+    tmarked = tmarked*(top>t*np.amax(top)*t/2)*(1-colseps)
+    tmarked = maximum_filter(tmarked,(1,20))
+    delta = max(3,int(scale/2))
+    seeds = seed_spans(bmarked,tmarked,delta,5*scale)
+    seeds = maximum_filter(seeds,(1,int(1+scale)))
+    seeds = seeds*(1-colseps)
+    DSAVE(debug,"lineseeds",[seeds,0.3*tmarked+0.7*bmarked,binary])
+    seeds, _ = morph.label(seeds)
+    return seeds
+
+
+################################################################
+### The complete line segmentation process.
+################################################################
+
+def without_hlines(components, scale, maxsize=10):
+    """Remove the components wider than maxsize*scale (horizontal black lines)
+    from a morph.ComponentIndex."""
+    r0,r1,c0,c1 = components.rasters().T
+    return components.select((c1-c0) <= maxsize * scale)
+
+
+def remove_hlines(binary, scale, maxsize=10):
+    return without_hlines(morph.ComponentIndex(binary), scale, maxsize).binary()
+
+
+class PageStages:
+    """The intermediate results of the line segmentation of a page (1 for ink),
+    computed on demand.  Each stage keeps its most recent result together with
+    the parameters it depends on, so that segmenting the same page again with
+    different parameters (see ocropus-gpageseg --sweep) only recomputes the
+    stages whose parameters changed.  `components` is the morph.ComponentIndex
+    of the page, if it is already known."""
+    def __init__(self,binary,mask=None,debug=False,components=None):
+        self.binary = np.asarray(binary,'B')
+        if components is None:
+            components = morph.ComponentIndex(self.binary)
+        self.components = components
+        self.mask = mask
+        self.debug = debug
+        self.cache = {}
+
+    def stage(self,name,key,f):
+        """Return the result of `f()`, unless it is cached under the same key."""
+        if name not in self.cache or self.cache[name][0]!=key:
+            self.cache[name] = (key, f())
+        return self.cache[name][1]
+
+    def estimate_scale(self):
+        return self.stage("scale", None,
+                          lambda: psegutils.estimate_scale(self.binary, self.components))
+
+    def reduced(self,factor):
+        """The stages of the page downsampled by `factor` (see reduce_binary)."""
+        def f():
+            mask = None if self.mask is None else reduce_binary(self.mask, factor)
+            return PageStages(reduce_binary(self.binary, factor), mask, self.debug)
+        return self.stage("reduced", factor, f)
+
+    def without_hlines(self,scale):
+        # horizontal black lines only interfere with the rest of the page segmentation
+        return self.stage("hlines", scale, lambda: without_hlines(self.components, scale))
+
+    def colseps(self,scale,maxcolseps,maxseps,sepwiden,csminheight):
+        """The column separators and the separated page, with the black separators
+        and the mask removed, and its components (see compute_colseps)."""
+        key = (scale,maxcolseps,maxseps,sepwiden,csminheight)
+        return self.stage("colseps", key,
+                          lambda: self._colseps(scale,maxcolseps,maxseps,sepwiden,csminheight))
+
+    def _colseps(self,scale,maxcolseps,maxseps,sepwiden,csminheight):
+        debug = self.debug
+        components = self.without_hlines(scale)
+        binary = components.binary()
+        candidates = self.stage("candidates", scale,
+                                lambda: colsep_candidates(binary,scale,debug))
+        colseps = select_colseps(candidates,scale,maxcolseps,csminheight,debug)
+        DSAVE(debug,"colwsseps",0.7*colseps+0.3*binary)
+        separated = binary
+        if maxseps > 0:
+            seps = self.stage("blackseps", (scale,sepwiden,maxseps),
+                              lambda: compute_separators_morph(binary,scale,sepwiden,maxseps))
+            DSAVE(debug,"colseps", 0.7*seps+0.3*binary)
+            colseps = np.maximum(colseps, seps)
+            separated = np.minimum(separated, 1 - seps)
+        if self.mask is not None:
+            separated, colseps = apply_mask(separated, colseps, self.mask, debug)
+        if not np.array_equal(separated, binary):
+            # black column separators or the mask were removed from the components
+            components = morph.ComponentIndex(separated)
+        return colseps, separated, components
+
+    def gradmaps(self,scale,maxcolseps,maxseps,sepwiden,csminheight,usegauss,vscale,hscale):
+        """The gradient maps of the separated page and their peaks (see compute_gradmaps
+        and line_peaks)."""
+        _, separated, components = self.colseps(scale,maxcolseps,maxseps,sepwiden,csminheight)
+        # the separated page depends on the black separators and, with a mask,
+        # also on the whitespace separators
+        key = (scale,usegauss,vscale,hscale)
+        if maxseps > 0:
+            key += (maxseps,sepwiden)
+        if self.mask is not None:
+            key += (maxcolseps,csminheight)
+        def f():
+            bottom, top, boxmap = compute_gradmaps(separated,scale,usegauss,vscale,hscale,
+                                                   self.debug,components)
+            return bottom, top, boxmap, line_peaks(bottom,top,scale,vscale)
+        return self.stage("gradmaps", key, f)
+
+    def segmentation(self,scale,threshold=0.2,usegauss=False,vscale=1.0,hscale=1.0,
+                     maxcolseps=3,maxseps=0,sepwiden=10,csminheight=10):
+        """The line labels of the page (see compute_segmentation)."""
+        debug = self.debug
+        colseps, binary, _ = self.colseps(scale,maxcolseps,maxseps,sepwiden,csminheight)
+
+        # now compute the text line seeds
+        bottom, top, boxmap, peaks = self.gradmaps(scale,maxcolseps,maxseps,sepwiden,csminheight,
+                                                   usegauss,vscale,hscale)
+        seeds = compute_line_seeds(binary,bottom,top,colseps,scale,threshold,vscale,debug,peaks)
+        DSAVE(debug,"seeds",[bottom,top,boxmap])
+
+        # spread the text line seeds to all the remaining components
+        llabels = morph.propagate_labels(boxmap,seeds,conflict=0)
+        spread = morph.spread_labels(seeds,maxdist=scale)
+        llabels = np.where(llabels>0, llabels, spread*binary)
+        segmentation = llabels * binary
+        return segmentation
+
+
+def compute_segmentation(binary,scale,threshold=0.2,usegauss=False,vscale=1.0,hscale=1.0,
+                         maxcolseps=3,maxseps=0,sepwiden=10,csminheight=10,mask=None,
+                         debug=False,components=None):
+    """Given a binary image, compute a complete segmentation into lines, computing both columns and
+        text lines.  `components` is the morph.ComponentIndex of the image, if it is already known.
+    """
+    stages = PageStages(binary,mask,debug,components)
+    return stages.segmentation(scale,threshold,usegauss,vscale,hscale,
+                               maxcolseps,maxseps,sepwiden,csminheight)
+
+
+def reduce_binary(image,factor):
+    """Downsample a binary image by an integer factor; a pixel of the result is
+    set if any pixel of the corresponding block is set."""
+    h, w = image.shape
+    rh, rw = (h+factor-1)//factor, (w+factor-1)//factor
+    padded = np.zeros((rh*factor,rw*factor),'B')
+    padded[:h,:w] = (image!=0)
+    return padded.reshape(rh,factor,rw,factor).max(axis=3).max(axis=1)
+
+
+def expand_labels(labels,factor,shape):
+    """Upsample a label image by an integer factor (each pixel becomes a block)
+    and crop it to the given shape."""
+    labels = np.repeat(np.repeat(labels,factor,axis=0),factor,axis=1)
+    return labels[:shape[0],:shape[1]]
+
+
+def reduction_factor(scale,target=16.0):
+    """The largest integer downsampling factor that keeps the scale of the
+    page at least `target`; below that, lines start to get split."""
+    return max(1, int(scale/target))
+
+
+def page_stages(binary,mask=None,check=True,debug=False):
+    """Check a binary page image (1 for background, possibly a PackedBinary) and
+    return the PageStages for segmenting it (see segment).
+
+    Raises BadImage if (with `check`) the image does not look like a page image."""
+    if isinstance(binary, PackedBinary):
+        binary = binary.invert()
+    else:
+        checktype(binary, ABINARY2)
+        binary = 1-binary # invert
+    # the components of the page are labeled once for all the steps below
+    components = morph.ComponentIndex(binary)
+    if check:
+        problem = check_page(binary, components)
+        if problem is not None:
+            raise BadImage(problem)
+    if isinstance(binary, PackedBinary):
+        # the only dense copy of a packed page, made from the labels
+        binary = components.binary()
+    return PageStages(binary, mask, debug, components)
+
+
+def segment(binary,scale=0.0,minscale=12.0,maxlines=300,threshold=0.2,usegauss=False,
+            vscale=1.0,hscale=1.0,maxcolseps=3,maxseps=0,sepwiden=10,csminheight=10,
+            mask=None,reduce=1,check=True,debug=False):
+    """Segment a binary page image (1 for background, as written by ocropus-nlbin)
+    into text lines.  The parameters are those of ocropus-gpageseg; a scale of 0
+    means that the scale is estimated from the page.  Returns
+    `(segmentation, lines, scale)`: the page segmentation, with the lines
+    numbered 0x010001, 0x010002, ... in reading order, the line descriptors
+    (bounds and mask, see psegutils.compute_lines) in the same order, and the
+    scale that was used.
+
+    With `reduce` > 1, the columns and text lines are found on the page
+    downsampled by that factor (with the scale reduced accordingly), which is
+    much faster for high resolution scans; the line labels are then mapped
+    back to the pixels of the full resolution page.  With `reduce` = 0, the
+    factor is chosen from the scale (see reduction_factor).
+
+    The page may also be given as a PackedBinary, or as the PageStages returned
+    by page_stages, in which case `mask`, `check` and `debug` are those given to
+    page_stages and the intermediate results are shared with other calls.
+
+    Raises BadImage if (with `check`) the image does not look like a page
+    image, if the scale is unusable, or if there are more than `maxlines` lines."""
+    if isinstance(binary, PageStages):
+        stages = binary
+    else:
+        stages = page_stages(binary, mask, check, debug)
+    binary = stages.binary
+
+    if scale == 0:
+        scale = stages.estimate_scale()
+    if np.isnan(scale) or scale > 1000.0:
+        raise BadImage("bad scale (%g)" % scale)
+    if scale < minscale:
+        raise BadImage("scale (%g) less than minscale (%g)" % (scale, minscale))
+
+    # find columns and text lines
+    if reduce == 0:
+        reduce = reduction_factor(scale)
+    if reduce > 1:
+        segmentation = stages.reduced(reduce).segmentation(scale/reduce,threshold,usegauss,
+                                                           vscale,hscale,maxcolseps,maxseps,
+                                                           sepwiden,csminheight)
+        segmentation = expand_labels(segmentation, reduce, binary.shape)*(binary!=0)
+    else:
+        segmentation = stages.segmentation(scale,threshold,usegauss,vscale,hscale,
+                                           maxcolseps,maxseps,sepwiden,csminheight)
+    if np.amax(segmentation) > maxlines:
+        raise BadImage("too many lines %g" % np.amax(segmentation))
+
+    # compute the reading order
+    lines = psegutils.compute_lines(segmentation, scale)
+    order = psegutils.reading_order([l.bounds for l in lines])
+    lsort = psegutils.topsort(order)
+
+    # renumber the labels so that they conform to the specs
+    nlabels = np.amax(segmentation) + 1
+    renumber = np.zeros(nlabels, 'i')
+    for i, v in enumerate(lsort):
+        renumber[lines[v].label] = 0x010000+(i+1)
+    segmentation = renumber[segmentation]
+    lines = [lines[i] for i in lsort]
+    return segmentation, lines, scale
+
+
+def extract_lines(image,lines,pad=3,expand=3):
+    """Extract the masked line images for the line descriptors returned by
+    segment() from a page image, padded by `pad` pixels and with the masks
+    dilated by `expand` pixels."""
+    return [psegutils.extract_masked(image, l, pad=pad, expand=expand) for l in lines]
@@ -0,0 +1,179 @@
+################################################################
+### Line bundles.
+###
+### By default, ocropus-gpageseg writes every text line of a page as a
+### PNG file of its own (book/0001/010001.bin.png, ...), which means
+### hundreds of small files per page.  A line bundle keeps all the
+### lines of a page in one file, book/0001.lines.npz, with their ids,
+### their bounds in the page, their masks, and their binary (and,
+### optionally, grayscale) images.  The file is a numpy .npz archive
+### whose members are only read when they are accessed, so single
+### lines can be read without reading the rest:
+###
+###     with LineBundle("book/0001.lines.npz") as bundle:
+###         for id in bundle.ids:
+###             line = bundle.image(id)
+###
+### The lines are addressed as "book/0001.lines.npz[010001]" where a
+### single line file name is expected (see split_name).  The images are
+### stored as they would be written to and read back from PNG files,
+### so bundle.image returns exactly what read_image_gray returns for
+### the corresponding .bin.png or .nrm.png file.  ocropus-rpred writes
+### the recognized texts of a bundle to book/0001.lines.txt, one
+### "<id><TAB><text>" line per text line.
+################################################################
+
+from __future__ import print_function
+
+import codecs
+import collections
+import os
+import re
+
+import numpy as np
+
+suffix = ".lines.npz"
+text_suffix = ".lines.txt"
+
+
+def is_bundle(fname):
+    return fname.endswith(suffix)
+
+
+def line_name(fname, id):
+    """The name of a line of a bundle."""
+    return "%s[%06x]" % (fname, id)
+
+
+def split_name(fname):
+    """Split a line name into the bundle file name and the line id; for
+    other file names, the id is None."""
+    match = re.match(r'^(.*%s)\[([0-9a-fA-F]+)\]$' % re.escape(suffix), fname)
+    if not match:
+        return fname, None
+    return match.group(1), int(match.group(2), 16)
+
+
+def _midrange(image):
+    return 0.5*(float(np.amin(image))+float(np.amax(image)))
+
+
+def write_line_bundle(fname, lines, binlines, graylines=None):
+    """Write the lines of a page, given by the line descriptors returned by
+    gpageseg.segment and the line images returned by gpageseg.extract_lines,
+    to a bundle.  The ids are 0x010001, 0x010002, ... as for the line files
+    written by ocropus-gpageseg."""
+    assert is_bundle(fname), fname
+    n = len(lines)
+    assert len(binlines)==n and (graylines is None or len(graylines)==n)
+    contents = {}
+    contents["ids"] = np.arange(0x010001, 0x010001+n, dtype='int32')
+    contents["bounds"] = np.array([(l.bounds[0].start, l.bounds[1].start,
+                                    l.bounds[0].stop, l.bounds[1].stop) for l in lines],
+                                  'int32').reshape(n, 4)
+    contents["shapes"] = np.array([b.shape for b in binlines], 'int32').reshape(n, 2)
+    for id, l, binline in zip(contents["ids"], lines, binlines):
+        contents["mask_%06x" % id] = np.packbits(l.mask!=0, axis=1)
+        contents["bin_%06x" % id] = np.packbits(binline>_midrange(binline), axis=1)
+    if graylines is not None:
+        for id, grayline in zip(contents["ids"], graylines):
+            if grayline.dtype!=np.dtype('B'):
+                grayline = np.array(255*np.clip(grayline, 0.0, 1.0), 'B')
+            contents["nrm_%06x" % id] = grayline
+    # write under a temporary name so that a bundle is either complete or absent
+    tmpname = fname[:-len(".npz")]+".tmp.npz"
+    np.savez_compressed(tmpname, **contents)
+    os.rename(tmpname, fname)
+
+
+class LineBundle:
+    """The lines of a page written by write_line_bundle.  `ids` and `bounds`
+    (rows of y0, x0, y1, x1) are in reading order."""
+    def __init__(self, fname):
+        self.fname = fname
+        self.data = np.load(fname)
+        self.ids = [int(id) for id in self.data["ids"]]
+        self.bounds = self.data["bounds"]
+        self.shapes = self.data["shapes"]
+        self.index = {id: i for i, id in enumerate(self.ids)}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def names(self):
+        """The names of the lines (see line_name)."""
+        return [line_name(self.fname, id) for id in self.ids]
+
+    def bbox(self, id):
+        """The bounds of a line as (y0, x0, y1, x1)."""
+        return tuple(int(v) for v in self.bounds[self.index[id]])
+
+    def mask(self, id):
+        """The mask of a line within its bounds, as a boolean array."""
+        y0, x0, y1, x1 = self.bbox(id)
+        bits = self.data["mask_%06x" % id]
+        return np.unpackbits(bits, axis=1)[:, :x1-x0]!=0
+
+    def has_gray(self):
+        return len(self.ids)>0 and "nrm_%06x" % self.ids[0] in self.data.files
+
+    def image(self, id, kind="bin"):
+        """The binary ("bin") or grayscale ("nrm") image of a line, as a floating
+        point array in the range 0...1, as read_image_gray returns it."""
+        if kind=="nrm":
+            return self.data["nrm_%06x" % id]/255.0
+        assert kind=="bin", kind
+        h, w = self.shapes[self.index[id]]
+        bits = self.data["bin_%06x" % id]
+        return np.array(np.unpackbits(bits, axis=1)[:, :w], 'd')
+
+    def close(self):
+        self.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# the bundles kept open by open_bundle, least recently used first
+_open = collections.OrderedDict()
+cache_size = 4
+
+def open_bundle(fname):
+    """Open a bundle, reusing an already open one (each process keeps its
+    own).  Lines arrive grouped by page, so only the `cache_size` most
+    recently used bundles are kept open; the others are closed."""
+    if fname in _open:
+        _open[fname] = _open.pop(fname)
+    else:
+        while len(_open)>=cache_size:
+            _open.popitem(last=False)[1].close()
+        _open[fname] = LineBundle(fname)
+    return _open[fname]
+
+
+def text_name(fname):
+    """The name of the text file for the lines of a bundle."""
+    assert is_bundle(fname), fname
+    return fname[:-len(suffix)]+text_suffix
+
+
+def write_texts(fname, texts):
+    """Write a dict from line ids to texts."""
+    with codecs.open(fname, "w", "utf-8") as stream:
+        for id in sorted(texts):
+            stream.write(u"%06x\t%s\n" % (id, texts[id]))
+
+
+def read_texts(fname):
+    """Read a dict from line ids to texts written by write_texts."""
+    texts = {}
+    with codecs.open(fname, "r", "utf-8") as stream:
+        for line in stream:
+            line = line.rstrip(u"\n")
+            if line=="": continue
+            id, text = line.split(u"\t", 1)
+            texts[int(id, 16)] = text
+    return texts
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import os
+from collections import namedtuple
 
 import numpy as np
 import matplotlib.pyplot as plt
@@ -16,7 +17,21 @@ def scale_to_h(img,target_height,order=1,dtype=np.dtype('f'),cval=0):
     output = np.array(output,dtype=dtype)
     return output
 
+# The result of measuring a text line with CenterNormalizer.estimate: the
+# shape of the line, the (read-only) center line for every column, the mean
+# absolute deviation of the ink from it and the half height of the band
+# that is cut out around it.
+CenterMeasurement = namedtuple("CenterMeasurement","shape center mad r")
+
 class CenterNormalizer:
+    """Line normalizer that cuts out a band around the smoothed center line
+    of the text and rescales it to `target_height`.
+
+    `estimate` and the `measurement=` arguments of `dewarp` and `normalize`
+    do not modify the normalizer, so one instance can be shared between
+    threads.  `measure` is the older stateful interface: it also stores the
+    measurement in the instance, and `dewarp`/`normalize` use the stored
+    measurement when none is passed."""
     def __init__(self,target_height=48,params=(4,1.0,0.3)):
         self.debug = int(os.getenv("debug_center") or "0")
         self.target_height = target_height
@@ -24,38 +39,77 @@ class CenterNormalizer:
         print("# CenterNormalizer")
     def setHeight(self,target_height):
         self.target_height = target_height
-    def measure(self,line):
+    def estimate(self,line):
+        """Measure the center line of the given line image (ink>0) and
+        return a CenterMeasurement."""
         h,w = line.shape
-        smoothed = filters.gaussian_filter(line,(h*0.5,h*self.smoothness),mode='constant')
-        smoothed += 0.001*filters.uniform_filter(smoothed,(h*0.5,w),mode='constant')
-        self.shape = (h,w)
+        # The horizontal smoothing is very wide (sigma h*smoothness), so the
+        # center line is estimated on a copy whose columns are averaged in
+        # blocks of k, and the resulting curve is interpolated back to the
+        # full width.  Rows are kept at full resolution.
+        k = max(1,int(h*self.smoothness/4))
+        nk = (w+k-1)//k
+        small = np.zeros((h,nk*k),'f')
+        small[:,:w] = line
+        small = np.mean(small.reshape(h,nk,k),axis=2)
+        smoothed = filters.gaussian_filter(small,(h*0.5,h*self.smoothness/k),mode='constant')
+        smoothed += 0.001*filters.uniform_filter(smoothed,(h*0.5,w*1.0/k),mode='constant')
         a = np.argmax(smoothed,axis=0)
+        a = np.interp(np.arange(w),k*np.arange(nk)+0.5*(k-1),a)
         a = filters.gaussian_filter(a,h*self.extra)
-        self.center = np.array(a,'i')
-        deltas = np.abs(np.arange(h)[:,np.newaxis]-self.center[np.newaxis,:])
-        self.mad = np.mean(deltas[line!=0])
-        self.r = int(1+self.range*self.mad)
+        center = np.array(a,'i')
+        center.flags.writeable = False
+        deltas = np.abs(np.arange(h)[:,np.newaxis]-center[np.newaxis,:])
+        mad = np.mean(deltas[line!=0])
+        r = int(1+self.range*mad)
         if self.debug:
             plt.figure("center")
             plt.imshow(line,cmap=plt.cm.gray)
-            plt.plot(self.center)
+            plt.plot(center)
             plt.ginput(1,1000)
-    def dewarp(self,img,cval=0,dtype=np.dtype('f')):
-        assert img.shape==self.shape
+        return CenterMeasurement((h,w),center,mad,r)
+    def measure(self,line):
+        """Like `estimate`, but also stores the measurement in the
+        normalizer for subsequent `dewarp`/`normalize` calls."""
+        m = self.estimate(line)
+        self.shape,self.center,self.mad,self.r = m
+        return m
+    def _measurement(self,measurement):
+        if measurement is not None:
+            return measurement
+        return CenterMeasurement(self.shape,self.center,self.mad,self.r)
+    def dewarp(self,img,cval=0,dtype=np.dtype('f'),measurement=None):
+        m = self._measurement(measurement)
+        assert img.shape==m.shape
         h,w = img.shape
-        # The actual image img is embedded into a larger image by
-        # adding vertical space on top and at the bottom (padding)
-        hpadding = self.r # this is large enough
-        padded = np.vstack([cval*np.ones((hpadding,w)),img,cval*np.ones((hpadding,w))])
-        center = self.center + hpadding
-        dewarped = [padded[center[i]-self.r:center[i]+self.r,i] for i in range(w)]
-        dewarped = np.array(dewarped,dtype=dtype).T
+        # Gather the band of 2*r rows around the center line of every
+        # column in one indexing operation; rows that fall outside the
+        # image (the padding) are filled with cval.
+        rows = m.center[np.newaxis,:]+np.arange(-m.r,m.r)[:,np.newaxis]
+        inside = (rows>=0)&(rows<h)
+        dewarped = np.where(inside,img[np.clip(rows,0,h-1),np.arange(w)[np.newaxis,:]],cval)
+        dewarped = np.array(dewarped,dtype=dtype)
         return dewarped
-    def normalize(self,img,order=1,dtype=np.dtype('f'),cval=0):
-        dewarped = self.dewarp(img,cval=cval,dtype=dtype)
-        h,w = dewarped.shape
-        # output = zeros(dewarped.shape,dtype)
-        scaled = scale_to_h(dewarped,self.target_height,order=order,dtype=dtype,cval=cval)
-        return scaled
-
-
+    def normalize(self,img,order=1,dtype=np.dtype('f'),cval=0,measurement=None):
+        m = self._measurement(measurement)
+        assert img.shape==m.shape
+        h,w = img.shape
+        # Dewarping and rescaling to the target height are done in a
+        # single resampling pass: output pixel (y,x) is taken from column
+        # x/scale of the input, y/scale rows below the top of the band
+        # around the (interpolated) center line.
+        scale = self.target_height*1.0/(2*m.r)
+        target_width = int(scale*w)
+        ys = np.arange(self.target_height)/scale
+        xs = np.arange(target_width)/scale
+        top = np.interp(xs,np.arange(w),m.center)-m.r
+        # a few rows of cval above and below, so that the band edges are
+        # interpolated against the background just like the padded dewarp
+        hpadding = order+1
+        padded = np.pad(1.0*img,((hpadding,hpadding),(0,0)),mode='constant',constant_values=cval)
+        rows = ys[:,np.newaxis]+top[np.newaxis,:]+hpadding
+        cols = np.broadcast_to(xs[np.newaxis,:],rows.shape)
+        output = interpolation.map_coordinates(padded,[rows,cols],order=order,
+                                               mode='constant',cval=cval)
+        output = np.array(output,dtype=dtype)
+        return output
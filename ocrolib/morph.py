@@ -7,7 +7,39 @@ from pylab import *
 from scipy.ndimage import morphology, measurements, filters
 from scipy.ndimage.morphology import *
 from toplevel import *
-
+import functools
+import sl
+from ocrolib.packed import PackedBinary
+from ocrolib import pfilters
+
+def unpacks(f):
+    """Let `f` also accept a PackedBinary as its first argument, which is
+    unpacked into a dense array first."""
+    @functools.wraps(f)
+    def wrapper(image,*args,**kw):
+        if isinstance(image,PackedBinary):
+            image = image.unpack()
+        return f(image,*args,**kw)
+    return wrapper
+
+def bandwise(passes):
+    """Let a rectangle operation `f(image,size,origin=0)` also accept a
+    PackedBinary.  The operation is then applied to bands of rows (see
+    PackedBinary.map_bands) and the result is packed again, so that only
+    one band at a time is dense.  `passes` is the number of filtering passes
+    of `f`, which determines its vertical reach."""
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(image,size,origin=0):
+            if not isinstance(image,PackedBinary):
+                return f(image,size,origin=origin)
+            shift = origin if isscalar(origin) else origin[0]
+            margin = passes*(int(ceil(size[0]))+abs(int(shift))+1)
+            return image.map_bands(lambda band: f(band,size,origin=origin),margin)
+        return wrapper
+    return decorator
+
+@unpacks
 @checks(ABINARY2)
 def label(image,**kw):
     """Redefine the scipy.ndimage.measurements.label function to work with a wider range of data
@@ -46,71 +78,149 @@ def find_objects(image, **kw):
     # let it raise the same exception as before
     return measurements.find_objects(image,**kw)
 
+class ComponentIndex:
+    """The connected components of a binary image.  The image is labeled once,
+    and the bounding boxes, pixel counts and centroids of the components are
+    computed when first needed and then kept, so that the steps of a page
+    segmentation can share them instead of labeling the same page again.
+    `select` gives the index of the image with some of the components removed
+    without labeling again."""
+    def __init__(self,binary,labels=None,n=None):
+        if labels is None:
+            labels,n = label(binary)
+        self.labels = labels
+        self.n = n
+        self._objects = None
+        self._rasters = None
+        self._areas = None
+        self._centroids = None
+    def binary(self):
+        """The image of all the components (as a uint8 array)."""
+        return array(self.labels!=0,'B')
+    def objects(self):
+        """The bounding boxes of the components, as returned by find_objects."""
+        if self._objects is None:
+            self._objects = find_objects(self.labels)
+        return self._objects
+    def rasters(self):
+        """The bounding boxes as an n x 4 array of (row0,row1,col0,col1)."""
+        if self._rasters is None:
+            self._rasters = array([sl.raster(o) for o in self.objects()],'i').reshape(-1,4)
+        return self._rasters
+    def boxareas(self):
+        """The areas of the bounding boxes."""
+        r0,r1,c0,c1 = self.rasters().T
+        return (r1-r0)*(c1-c0)
+    def areas(self):
+        """The number of pixels of each component."""
+        if self._areas is None:
+            self._areas = bincount(self.labels.ravel(),minlength=self.n+1)[1:]
+        return self._areas
+    def centroids(self):
+        """The centroids of the components as an n x 2 array of (row,col)."""
+        if self._centroids is None:
+            rows,cols = indices(self.labels.shape)
+            flat = self.labels.ravel()
+            sums = [bincount(flat,weights=c.ravel(),minlength=self.n+1)[1:] for c in (rows,cols)]
+            self._centroids = array(sums).T/maximum(self.areas(),1)[:,newaxis]
+        return self._centroids
+    def select(self,keep):
+        """Return the index of the components for which `keep` is true, renumbered
+        consecutively (as label would number them)."""
+        keep = asarray(keep,bool)
+        renumber = zeros(self.n+1,'i')
+        renumber[1:][keep] = arange(1,sum(keep)+1)
+        result = ComponentIndex(None,renumber[self.labels],int(sum(keep)))
+        if self._objects is not None:
+            result._objects = [o for o,k in zip(self._objects,keep) if k]
+        if self._rasters is not None:
+            result._rasters = self._rasters[keep]
+        if self._areas is not None:
+            result._areas = self._areas[keep]
+        if self._centroids is not None:
+            result._centroids = self._centroids[keep]
+        return result
+
 def check_binary(image):
     assert image.dtype=='B' or image.dtype=='i' or image.dtype==dtype('bool'),\
         "array should be binary, is %s %s"%(image.dtype,image.shape)
     assert amin(image)>=0 and amax(image)<=1,\
         "array should be binary, has values %g to %g"%(amin(image),amax(image))
 
+@bandwise(1)
 @checks(ABINARY2,uintpair)
 def r_dilation(image,size,origin=0):
     """Dilation with rectangular structuring element using maximum_filter"""
-    return filters.maximum_filter(image,  size ,origin=origin)
+    return pfilters.maximum_filter(image,  size ,origin=origin)
 
+@bandwise(1)
 @checks(ABINARY2,uintpair)
 def r_erosion(image,size,origin=0):
     """Erosion with rectangular structuring element using maximum_filter"""
-    return filters.minimum_filter(image,size,origin=origin)
+    return pfilters.minimum_filter(image,size,origin=origin)
 
+@bandwise(2)
 @checks(ABINARY2,uintpair)
 def r_opening(image,size,origin=0):
     """Opening with rectangular structuring element using maximum/minimum filter"""
     check_binary(image)
-    image = r_erosion(image,size,origin=origin)
-    return r_dilation(image,size,origin=origin)
+    image = pfilters.minimum_filter(image,size,origin=origin)
+    return pfilters.maximum_filter(image,size,origin=origin)
 
+@bandwise(2)
 @checks(ABINARY2,uintpair)
 def r_closing(image,size,origin=0):
     """Closing with rectangular structuring element using maximum/minimum filter"""
     check_binary(image)
-    image = r_dilation(image,size,origin=0)
-    return r_erosion(image,size,origin=0)
+    image = pfilters.maximum_filter(image,size,origin=0)
+    return pfilters.minimum_filter(image,size,origin=0)
+
+# The rb_* functions use the same running maximum/minimum filters as
+# the r_* functions (their cost per pixel does not depend on the size
+# of the rectangle), but treat everything outside the image as
+# background instead of reflecting the image at its borders.
 
+def _rb_dilation(image,size,origin=0):
+    return pfilters.maximum_filter(image,size,origin=origin,mode='constant',cval=0)
+
+def _rb_erosion(image,size,origin=0):
+    return pfilters.minimum_filter(image,size,origin=origin,mode='constant',cval=1)
+
+@bandwise(1)
 @checks(ABINARY2,uintpair)
 def rb_dilation(image,size,origin=0):
-    """Binary dilation using linear filters."""
-    output = zeros(image.shape,'f')
-    filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=0)
-    return array(output>0,'i')
+    """Binary dilation using running maximum filters."""
+    return array(_rb_dilation(image,size,origin=origin)>0,'i')
 
+@bandwise(1)
 @checks(ABINARY2,uintpair)
 def rb_erosion(image,size,origin=0):
-    """Binary erosion using linear filters."""
-    output = zeros(image.shape,'f')
-    filters.uniform_filter(image,size,output=output,origin=origin,mode='constant',cval=1)
-    return array(output==1,'i')
+    """Binary erosion using running minimum filters."""
+    return array(_rb_erosion(image,size,origin=origin)>0,'i')
 
+@bandwise(2)
 @checks(ABINARY2,uintpair)
 def rb_opening(image,size,origin=0):
-    """Binary opening using linear filters."""
-    image = rb_erosion(image,size,origin=origin)
-    return rb_dilation(image,size,origin=origin)
+    """Binary opening using running minimum/maximum filters."""
+    image = _rb_erosion(image,size,origin=origin)
+    return array(_rb_dilation(image,size,origin=origin)>0,'i')
 
+@bandwise(2)
 @checks(ABINARY2,uintpair)
 def rb_closing(image,size,origin=0):
-    """Binary closing using linear filters."""
-    image = rb_dilation(image,size,origin=origin)
-    return rb_erosion(image,size,origin=origin)
+    """Binary closing using running maximum/minimum filters."""
+    image = _rb_dilation(image,size,origin=origin)
+    return array(_rb_erosion(image,size,origin=origin)>0,'i')
 
 @checks(GRAYSCALE,uintpair)
 def rg_dilation(image,size,origin=0):
     """Grayscale dilation with maximum/minimum filters."""
-    return filters.maximum_filter(image,size,origin=origin)
+    return pfilters.maximum_filter(image,size,origin=origin)
 
 @checks(GRAYSCALE,uintpair)
 def rg_erosion(image,size,origin=0):
     """Grayscale erosion with maximum/minimum filters."""
-    return filters.minimum_filter(image,size,origin=origin)
+    return pfilters.minimum_filter(image,size,origin=origin)
 
 @checks(GRAYSCALE,uintpair)
 def rg_opening(image,size,origin=0):
@@ -131,17 +241,34 @@ def showlabels(x,n=7):
 
 
 @checks(SEGMENTATION)
-def spread_labels(labels, maxdist=9999999):
-    """Spread the given labels to the background"""
-    print("** spread_labels: labels=%s" % desc(labels))
-    distances, features = morphology.distance_transform_edt(labels==0,
-                                return_distances=1, return_indices=1)
-    indexes = features[0]*labels.shape[1] + features[1]
-    print("indexes=%s" % desc(indexes))
-    spread = labels.ravel()[indexes.ravel()].reshape(*labels.shape)
-    print("spread=%s" % desc(spread))
-    spread *= (distances<maxdist)
-    print("spread=%s" % desc(spread))
+def spread_labels(labels, maxdist=9999999, tile=256):
+    """Spread the given labels to the background pixels closer than `maxdist`
+    (each pixel gets the label of the nearest labeled pixel).  The distance
+    transform is computed for tiles of the image, each extended by `maxdist`
+    on all sides; tiles without labels within that distance are skipped, so
+    with a small `maxdist` the work is proportional to the labeled area."""
+    h, w = labels.shape
+    margin = int(ceil(max(maxdist,0)))
+    if margin>=max(h,w):
+        tile, margin = max(h,w), 0
+    spread = zeros(labels.shape, labels.dtype)
+    # which tiles have labels within reach, from the labels per tile
+    nh, nw = (h+tile-1)//tile, (w+tile-1)//tile
+    occupied = zeros((nh*tile,nw*tile), bool)
+    occupied[:h,:w] = (labels!=0)
+    occupied = occupied.reshape(nh,tile,nw,tile).any(axis=3).any(axis=1)
+    reach = 2*((margin+tile-1)//tile)+1
+    occupied = filters.maximum_filter(occupied, (reach,reach), mode="constant")
+    for i, j in zip(*nonzero(occupied)):
+        r0, c0 = i*tile, j*tile
+        r1, c1 = min(h,r0+tile), min(w,c0+tile)
+        a0, b0 = max(0,r0-margin), max(0,c0-margin)
+        sub = labels[a0:min(h,r1+margin), b0:min(w,c1+margin)]
+        if not sub.any(): continue
+        distances, features = morphology.distance_transform_edt(sub==0,
+                                    return_distances=1, return_indices=1)
+        near = sub[features[0], features[1]]*(distances<maxdist)
+        spread[r0:r1,c0:c1] = near[r0-a0:r1-a0, c0-b0:c1-b0]
     return spread
 
 
@@ -161,28 +288,45 @@ def remove_marked(image,markers):
     marked = keep_marked(image,markers)
     return image*(marked==0)
 
+def pair_keys(labels1, labels2):
+    """Combine two (non-negative) label arrays into 64 bit keys that sort like
+        the pairs (labels1, labels2)."""
+    return (asarray(labels1,'int64')<<32) | asarray(labels2,'int64')
+
+def split_keys(keys):
+    """Split keys made by pair_keys into the two label arrays."""
+    return keys>>32, keys&0xffffffff
+
 @checks(SEGMENTATION,SEGMENTATION)
 def correspondences(labels1, labels2):
     """Given two labeled images, compute an array giving the correspondences between labels in the
         two images.
     """
-    q = 100000
     assert amin(labels1)>=0 and amin(labels2)>=0
-    assert amax(labels2)<q
-    combo = labels1*q + labels2
-    result = unique(combo)
-    result = array([result//q, result%q])
-    return result
+    assert amax(labels2)<2**32
+    foreground = (labels1!=0)|(labels2!=0)
+    keys = unique(pair_keys(labels1[foreground], labels2[foreground]))
+    if not foreground.all():
+        keys = r_[0, keys]
+    return array(split_keys(keys))
+
+def overlapping_labels(regions, labels):
+    """For the labeled regions and labels (two label images), return the (sorted,
+        distinct) pairs of a region and a nonzero label that overlap it."""
+    both = (regions!=0)&(labels!=0)
+    return split_keys(unique(pair_keys(regions[both], labels[both])))
 
 @checks(ABINARY2,SEGMENTATION)
 def propagate_labels_simple(regions,labels):
     """Given an image and a set of labels, apply the labels
     to all the regions in the image that overlap a label."""
     rlabels,_ = label(regions)
-    cors = correspondences(rlabels,labels)
+    o, i = overlapping_labels(rlabels, labels)
+    # of several labels, the largest one wins
+    last = ones(len(o),bool)
+    last[:-1] = (o[1:]!=o[:-1])
     outputs = zeros(amax(rlabels)+1,'i')
-    for o,i in cors.T: outputs[o] = i
-    outputs[0] = 0
+    outputs[o[last]] = i[last]
     return outputs[rlabels]
 
 
@@ -193,53 +337,65 @@ def propagate_labels(image, labels, conflict=0):
         Assign the value `conflict` to any labels that have a conflict.
     """
     rlabels, _ = label(image)
-    cors = correspondences(rlabels, labels)
+    o, i = overlapping_labels(rlabels, labels)
+    counts = bincount(o, minlength=amax(rlabels)+1)
     outputs = zeros(amax(rlabels)+1, 'i')
-    oops = -(1<<30)
-    for o, i in cors.T:
-        if outputs[o] != 0:
-            outputs[o] = oops
-        else:
-            outputs[o] = i
-    outputs[outputs==oops] = conflict
+    outputs[o] = i
+    outputs[counts>1] = conflict
     outputs[0] = 0
     return outputs[rlabels]
 
+# The scores of the bounding boxes for the functions of sl that select_regions
+# is usually called with, computed for all the boxes at once from the columns
+# (r0,r1,c0,c1) of ComponentIndex.rasters.
+box_scores = {
+    "dim0": lambda r0,r1,c0,c1: r1-r0,
+    "height": lambda r0,r1,c0,c1: r1-r0,
+    "dim1": lambda r0,r1,c0,c1: c1-c0,
+    "width": lambda r0,r1,c0,c1: c1-c0,
+    "aspect": lambda r0,r1,c0,c1: (r1-r0)*1.0/(c1-c0),
+    "area": lambda r0,r1,c0,c1: (r1-r0)*(c1-c0),
+}
+
+def score_regions(components, f):
+    """Apply a scoring function over slice tuples to all the components of a
+    ComponentIndex.  The functions of sl in `box_scores` are evaluated on the
+    arrays of bounding boxes, others on each box in turn."""
+    score = None
+    if getattr(f,"__module__",None) in ("sl","ocrolib.sl"):
+        score = box_scores.get(f.__name__)
+    if score is None:
+        return array([f(o) for o in components.objects()])
+    # the same dtypes as for the scores computed one by one
+    r0,r1,c0,c1 = array(components.rasters(),'int64').T
+    return score(r0,r1,c0,c1)
+
 @checks(ABINARY2,True)
 def select_regions(binary, f, min=0, nbest=100000):
     """Given a scoring function `f` over slice tuples (as returned by find_objects), keeps at most
         `nbest` regions whose scores are higher than `min`.
     """
-    labels, n = label(binary)
-    objects = find_objects(labels)
-    scores = [f(o) for o in objects]
+    components = ComponentIndex(binary)
+    scores = score_regions(components, f)
     best = argsort(scores)
-    keep = zeros(len(objects)+1, 'i')
+    keep = zeros(components.n+1, 'i')
     if nbest > 0:
-        for i in best[-nbest:]:
-            if scores[i]<=min:
-                continue
-            keep[i+1] = 1
-    # print scores,best[-nbest:],keep
-    # print sorted(list(set(labels.ravel())))
-    # print sorted(list(set(keep[labels].ravel())))
-    return keep[labels]
+        best = best[-nbest:]
+        keep[best[scores[best]>min]+1] = 1
+    return keep[components.labels]
 
 @checks(SEGMENTATION)
 def all_neighbors(image):
     """Given an image with labels, find all pairs of labels
-    that are directly neighboring each other."""
-    q = 100000
-    assert amax(image)<q
+    that are directly neighboring each other (horizontally or
+    vertically), as an array of rows (a,b) with a<b."""
     assert amin(image)>=0
-    u = unique(q*image+roll(image,1,0))
-    d = unique(q*image+roll(image,-1,0))
-    l = unique(q*image+roll(image,1,1))
-    r = unique(q*image+roll(image,-1,1))
-    all = unique(r_[u,d,l,r])
-    all = c_[all//q,all%q]
-    all = unique(array([sorted(x) for x in all]))
-    return all
+    keys = []
+    for u,v in [(image[1:,:],image[:-1,:]),(image[:,1:],image[:,:-1])]:
+        differ = (u!=v)
+        a, b = u[differ], v[differ]
+        keys.append(unique(pair_keys(minimum(a,b), maximum(a,b))))
+    return array(split_keys(unique(concatenate(keys)))).T
 
 ################################################################
 ### Iterate through the regions of a color image.
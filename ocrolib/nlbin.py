@@ -0,0 +1,415 @@
+################################################################
+### Non-linear page binarization (the algorithm behind ocropus-nlbin).
+###
+### All functions take their parameters explicitly and work on
+### arrays, so pages can be binarized in-process:
+###
+###     binary, normalized, angle, lo, hi = nlbin.binarize(raw)
+################################################################
+
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import matplotlib.pyplot as plt
+from scipy.ndimage import interpolation,morphology
+from scipy import stats
+
+from ocrolib import pfilters
+from ocrolib.exceptions import BadImage
+
+
+def check_page(image):
+    """Check whether the (inverted) image looks like a page image.  Returns
+    None if it does and an explanation otherwise."""
+    if len(image.shape)==3: return "input image is color image %s"%(image.shape,)
+    if np.mean(image)<np.median(image): return "image may be inverted"
+    h,w = image.shape
+    if h<600: return "image not tall enough for a page image %s"%(image.shape,)
+    if h>10000: return "image too tall for a page image %s"%(image.shape,)
+    if w<600: return "image too narrow for a page image %s"%(image.shape,)
+    if w>10000: return "line too wide for a page image %s"%(image.shape,)
+    return None
+
+
+def normalize_raw_image(raw):
+    """ perform image normalization """
+    image = raw - np.amin(raw)
+    if np.amax(image)==np.amin(image):
+        return None
+    image /= np.amax(image)
+    return image
+
+
+def is_binarized(image, frac=0.95, strip=1024):
+    """Check whether the image is already effectively binary, that is,
+    whether more than `frac` of its pixels are within 5% of the darkest or
+    the lightest value.  The pixels are counted in strips of `strip` rows,
+    so that no temporary arrays of the size of the image are needed."""
+    lo, hi = np.amin(image), np.amax(image)
+    l, u = lo+0.05*(hi-lo), lo+0.95*(hi-lo)
+    extreme = sum(np.sum(image[y:y+strip]<l)+np.sum(image[y:y+strip]>u)
+                  for y in np.arange(0, image.shape[0], strip))
+    return extreme*1.0/np.prod(image.shape) > frac
+
+
+def estimate_local_whitelevel(image, zoom=0.5, perc=80, range=20, debug=0, method="percentile"):
+    """flatten it by estimating the local whitelevel
+    zoom for page background estimation, smaller=faster, default: %(default)s
+    percentage for filters, default: %(default)s
+    range for filters, default: %(default)s
+    method is "percentile" (percentile filters on the zoomed page) or "grid"
+    (percentiles over a coarse grid of blocks, interpolated back)
+    """
+    if method=="grid":
+        m = whitelevel_grid(image, zoom, perc, range)
+    else:
+        m = interpolation.zoom(image, zoom)
+        m = pfilters.percentile_filter(m, perc, size=(range, 2))
+        m = pfilters.percentile_filter(m, perc, size=(2, range))
+        m = interpolation.zoom(m, 1.0/zoom)
+    if debug>0:
+        plt.clf()
+        plt.imshow(m,vmin=0,vmax=1)
+        plt.ginput(1,debug)
+    w, h = np.minimum(np.array(image.shape), np.array(m.shape))
+    flat = np.clip(image[:w,:h]-m[:w,:h]+1,0,1)
+    if debug>0:
+        plt.clf()
+        plt.imshow(flat,vmin=0,vmax=1)
+        plt.ginput(1,debug)
+    return flat
+
+
+def whitelevel_grid(image, zoom=0.5, perc=80, range=20):
+    """Fast estimate of the page background.  The page is cut into square
+    blocks of half the filter range (in full-resolution pixels), the given
+    percentile is computed for every block and over 2x2 neighbouring blocks,
+    and the block values are interpolated bilinearly back to full size."""
+    h, w = image.shape
+    b = max(1, int(range/zoom/2))
+    bh, bw = (h+b-1)//b, (w+b-1)//b
+    padded = np.pad(image, ((0,bh*b-h),(0,bw*b-w)), mode='edge')
+    blocks = padded.reshape(bh,b,bw,b).transpose(0,2,1,3).reshape(bh,bw,b*b)
+    grid = np.percentile(blocks, perc, axis=2)
+    grid = pfilters.percentile_filter(grid, perc, size=(2,2))
+    def linear(n, nb):
+        # source block coordinates (block centers) for n output pixels
+        pos = np.clip((np.arange(n)-0.5*(b-1))/b, 0, nb-1)
+        i0 = np.array(np.floor(pos),'i')
+        return i0, np.minimum(i0+1, nb-1), pos-i0
+    y0, y1, fy = linear(h, bh)
+    x0, x1, fx = linear(w, bw)
+    rows = grid[y0]*(1-fy)[:,np.newaxis]+grid[y1]*fy[:,np.newaxis]
+    return rows[:,x0]*(1-fx)+rows[:,x1]*fx
+
+
+def downsample(image, d):
+    """Reduce the image by averaging d x d blocks (trailing rows and
+    columns that do not fill a block are dropped)."""
+    if d<=1: return image
+    h, w = image.shape
+    h, w = h//d*d, w//d*d
+    return np.mean(image[:h,:w].reshape(h//d,d,w//d,d),axis=(1,3))
+
+
+def skew_profile_variance(image, a):
+    """Variance of the row projection profile of the image after
+    deskewing it by angle a (degrees).  For the small angles considered
+    here, the rotation is approximated by a vertical shear, and the profile
+    is accumulated directly with bincount instead of rotating the image."""
+    h, w = image.shape
+    shift = -np.tan(np.radians(a))*np.arange(w)
+    shift = np.array(np.round(shift-np.amin(shift)),'i')
+    rows = np.arange(h)[:,np.newaxis]+shift[np.newaxis,:]
+    profile = np.bincount(rows.ravel(), weights=image.ravel())
+    return np.var(profile)
+
+
+def estimate_skew_angle(image, angles, debug=0):
+    """Return the angle from `angles` that maximizes the variance of the
+    row projection profile.  The search is coarse-to-fine: every fourth
+    angle is tried on a strongly downsampled page, then the angles around
+    the best coarse estimate are tried at a finer resolution."""
+    d = max(1, int(round(image.shape[1]/800.0)))
+    step = 4
+    coarse = downsample(image, 2*d)
+    estimates = [(skew_profile_variance(coarse, a), i) for i, a in enumerate(angles[::step])]
+    _, best = max(estimates)
+    best *= step
+    fine = downsample(image, d)
+    lo, hi = max(0, best-step+1), min(len(angles), best+step)
+    estimates = [(skew_profile_variance(fine, a), a) for a in angles[lo:hi]]
+    if debug>0:
+        plt.plot([y for x,y in estimates],[x for x,y in estimates])
+        plt.ginput(1,debug)
+    _, a = max(estimates)
+    return a
+
+
+def estimate_skew(flat, bignore=0.1, maxskew=2, skewsteps=8, debug=0):
+    """estimate skew angle and rotate"""
+    d0, d1 = flat.shape
+    o0,o1 = int(bignore*d0),int(bignore*d1) # border ignore
+    flat = np.amax(flat)-flat
+    flat -= np.amin(flat)
+    est = flat[o0:d0-o0,o1:d1-o1]
+    ma = maxskew
+    ms = int(2*maxskew*skewsteps)
+    angle = estimate_skew_angle(est, np.linspace(-ma, ma, ms+1), debug)
+    flat = interpolation.rotate(flat,angle,mode='constant',reshape=0)
+    flat = np.amax(flat)-flat
+    return flat, angle
+
+
+def estimate_thresholds(flat, bignore=0.1, escale=1.0, lo=5, hi=90, debug=0):
+    """# estimate low and high thresholds
+        ignore this much of the border for threshold estimation, default: %(default)s
+        scale for estimating a mask over the text region, default: %(default)s
+        lo percentile for black estimation, default: %(default)s
+        hi percentile for white estimation, default: %(default)s
+    """
+    d0,d1 = flat.shape
+    o0,o1 = int(bignore*d0),int(bignore*d1)
+    est = flat[o0:d0-o0,o1:d1-o1]
+    if escale>0:
+        # by default, we use only regions that contain
+        # significant variance; this makes the percentile
+        # based low and high estimates more reliable
+        e = escale
+        v = est - pfilters.gaussian_filter(est,e*20.0)
+        v = pfilters.gaussian_filter(v**2,e*20.0)**0.5
+        v = (v>0.3*np.amax(v))
+        v = morphology.binary_dilation(v,structure=np.ones((int(e*50),1)))
+        v = morphology.binary_dilation(v,structure=np.ones((1,int(e*50))))
+        if debug>0:
+            plt.imshow(v)
+            plt.ginput(1,debug)
+        est = est[v]
+    lo = stats.scoreatpercentile(est.ravel(),lo)
+    hi = stats.scoreatpercentile(est.ravel(),hi)
+    return lo, hi
+
+
+def binarize(raw, threshold=0.5, zoom=0.5, escale=1.0, bignore=0.1, perc=80, range=20,
+             maxskew=2, skewsteps=8, lo=5, hi=90, gray=False, whitelevel="percentile",
+             check=True, debug=0):
+    """Binarize a page image (a grayscale array, dark text on a light
+    background).  The parameters are those of ocropus-nlbin.  Returns
+    `(binary, normalized, angle, lo, hi)`: the binary page (1 for background),
+    the normalized and deskewed grayscale page in [0,1], the skew angle that
+    was corrected, and the gray levels that were mapped to 0 and 1.
+
+    Raises BadImage if the image is empty or (with `check`) does not look
+    like a page image."""
+    image = normalize_raw_image(np.array(raw,'d'))
+    if image is None:
+        raise BadImage("image is empty")
+    if check:
+        problem = check_page(np.amax(image)-image)
+        if problem is not None:
+            raise BadImage(problem)
+
+    # if the image is not already effectively binarized, we need to
+    # flatten it by estimating the local whitelevel
+    if not gray and is_binarized(image):
+        flat = image
+    else:
+        flat = estimate_local_whitelevel(image, zoom, perc, range, debug, whitelevel)
+
+    # estimate skew angle and rotate
+    if maxskew>0:
+        flat, angle = estimate_skew(flat, bignore, maxskew, skewsteps, debug)
+    else:
+        angle = 0
+
+    # estimate low and high thresholds and rescale the image to get the
+    # normalized gray scale image
+    lo, hi = estimate_thresholds(flat, bignore, escale, lo, hi, debug)
+    flat -= lo
+    flat /= (hi-lo)
+    flat = np.clip(flat, 0, 1)
+    if debug>0:
+        plt.imshow(flat,vmin=0,vmax=1)
+        plt.ginput(1,debug)
+    binary = 1*(flat>threshold)
+    return binary, flat, angle, lo, hi
+
+
+################################################################
+### Tiled processing of very large pages.
+###
+### The page is given as 8 bit pixels; all floating point work is done
+### on tiles (plus a halo of context), and the intermediate and final
+### images are written tile by tile into memory-mapped files.
+################################################################
+
+def tile_slices(shape, tilesize, region=None):
+    """Iterate over the tiles (pairs of slices) covering the region
+    (a pair of slices, default: the whole array)."""
+    if region is None: region = (slice(0,shape[0]), slice(0,shape[1]))
+    for y in range(region[0].start, region[0].stop, tilesize):
+        for x in range(region[1].start, region[1].stop, tilesize):
+            yield (slice(y, min(y+tilesize, region[0].stop)),
+                   slice(x, min(x+tilesize, region[1].stop)))
+
+
+def grow_tile(tile, halo, region):
+    """Grow the tile by halo, clipped to the region.  Returns the grown
+    tile and the position of the original tile inside it."""
+    grown = tuple(slice(max(t.start-halo, r.start), min(t.stop+halo, r.stop))
+                  for t, r in zip(tile, region))
+    inner = tuple(slice(t.start-g.start, t.stop-g.start) for t, g in zip(tile, grown))
+    return grown, inner
+
+
+def reduce_strips(image, d, region):
+    """Average d x d blocks of the region of a (possibly memory-mapped)
+    image, reading it in strips of rows."""
+    (y0, y1), (x0, x1) = [(s.start, s.start+(s.stop-s.start)//d*d) for s in region]
+    strips = []
+    for y in range(y0, y1, 64*d):
+        strip = np.array(image[y:min(y+64*d, y1), x0:x1], 'f')
+        h, w = strip.shape
+        strips.append(np.mean(strip.reshape(h//d, d, w//d, d), axis=(1,3)))
+    return np.vstack(strips)
+
+
+def rotate_tile(image, tile, angle, cval):
+    """Compute one tile of the image rotated by angle (degrees) around the
+    center of the page, as interpolation.rotate(...,reshape=0) would."""
+    h, w = image.shape
+    cy, cx = (h-1)/2.0, (w-1)/2.0
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    y, x = np.mgrid[tile[0], tile[1]]
+    ys = cy+c*(y-cy)+s*(x-cx)
+    xs = cx-s*(y-cy)+c*(x-cx)
+    # only read the part of the page the tile maps from
+    margin = 4
+    sy0, sx0 = max(int(np.amin(ys))-margin, 0), max(int(np.amin(xs))-margin, 0)
+    sy1, sx1 = min(int(np.amax(ys))+margin, h), min(int(np.amax(xs))+margin, w)
+    if sy0>=sy1 or sx0>=sx1:
+        return cval*np.ones(ys.shape, 'f')
+    source = np.array(image[sy0:sy1, sx0:sx1], 'd')
+    return interpolation.map_coordinates(source, [ys-sy0, xs-sx0], order=3,
+                                         mode='constant', cval=cval)
+
+
+def check_tiled_page(overview, shape):
+    """Like check_page, for tiled processing: the image checks are done on
+    a reduced copy of the (inverted) page, and there is no upper limit on
+    the page size."""
+    if np.mean(overview)<np.median(overview): return "image may be inverted"
+    h,w = shape
+    if h<600: return "image not tall enough for a page image %s"%(shape,)
+    if w<600: return "image too narrow for a page image %s"%(shape,)
+    return None
+
+
+def tiled_geometry(maxmem, zoom=0.5, range=20, escale=1.0, whitelevel="percentile"):
+    """Tile size and halo for binarize_tiled such that the floating point
+    work arrays stay below about maxmem MB."""
+    # about a dozen float64 arrays of the size of a tile plus its halo
+    # are alive at the same time
+    halo = max(int(2*range/zoom), int(escale*(8*20+50)))
+    tilesize = max(int((maxmem*1e6/(12*8))**0.5)-2*halo, 256)
+    if whitelevel=="grid":
+        # align the tiles with the block grid of whitelevel_grid
+        b = max(1, int(range/zoom/2))
+        tilesize, halo = (tilesize//b)*b or b, (halo//b+1)*b
+    return tilesize, halo
+
+
+def binarize_tiled(raw, workdir, maxmem=1000, threshold=0.5, zoom=0.5, escale=1.0, bignore=0.1,
+                   perc=80, range=20, maxskew=2, skewsteps=8, lo=5, hi=90, gray=False,
+                   whitelevel="percentile", check=True):
+    """Binarize a (possibly very large) 8 bit page image tile by tile, so that
+    the memory needed for the floating point computations is bounded by about
+    `maxmem` MB regardless of the size of the page.  Scratch images and the
+    results are memory-mapped files in `workdir`.  Returns
+    `(binary, normalized, angle, lo, hi)` like `binarize`, except that the
+    two images are memory-mapped 8 bit images (0/255)."""
+    h, w = raw.shape
+    page = (slice(0,h), slice(0,w))
+    rmin, rmax = int(np.amin(raw)), int(np.amax(raw))
+    if rmax==rmin:
+        raise BadImage("image is empty")
+    def normalized(tile):
+        return (np.array(raw[tile], 'd')-rmin)/(rmax-rmin)
+    tilesize, halo = tiled_geometry(maxmem, zoom, range, escale, whitelevel)
+    d = max(1, int(np.ceil(max(h, w)/2000.0)))
+
+    if check:
+        overview = (reduce_strips(raw, d, page)-rmin)/(rmax-rmin)
+        problem = check_tiled_page(np.amax(overview)-overview, (h, w))
+        if problem is not None:
+            raise BadImage(problem)
+
+    flatten = gray or not is_binarized(raw)
+
+    def memmap(name, dtype):
+        return np.memmap(os.path.join(workdir, name), dtype=dtype, mode="w+", shape=(h, w))
+
+    # flatten the page by estimating the local whitelevel
+    flat = memmap("flat", 'f')
+    fmax = -np.inf
+    for tile in tile_slices((h, w), tilesize):
+        grown, inner = grow_tile(tile, halo, page)
+        image = normalized(grown)
+        if flatten:
+            image = estimate_local_whitelevel(image, zoom, perc, range, 0, whitelevel)
+            image = np.pad(image, [(0, g.stop-g.start-n) for g, n in zip(grown, image.shape)],
+                           mode='edge')
+        flat[tile] = image[inner]
+        fmax = max(fmax, np.amax(flat[tile]))
+
+    # estimate the skew angle on a reduced copy, then rotate tile by tile
+    o0, o1 = int(bignore*h), int(bignore*w)
+    est = (slice(o0, h-o0), slice(o1, w-o1))
+    angle = 0
+    if maxskew>0:
+        reduced = fmax-reduce_strips(flat, d, est)
+        ma = maxskew
+        ms = int(2*maxskew*skewsteps)
+        angle = estimate_skew_angle(reduced-np.amin(reduced), np.linspace(-ma, ma, ms+1))
+    if angle!=0:
+        rotated = memmap("rotated", 'f')
+        for tile in tile_slices((h, w), tilesize):
+            rotated[tile] = rotate_tile(flat, tile, angle, fmax)
+        flat = rotated
+
+    # estimate low and high thresholds from a sample of the pixels (and,
+    # with escale, of the local variance) of the center region
+    area = (est[0].stop-est[0].start)*(est[1].stop-est[1].start)
+    step = max(1, int((area/4e6)**0.5))
+    values, vmaxes, vglobal = [], [], 0
+    for tile in tile_slices((h, w), tilesize, est):
+        grown, inner = grow_tile(tile, halo, est)
+        sample = tuple(slice((-t.start)%step, None, step) for t in tile)
+        window = np.array(flat[grown], 'd')
+        values.append(window[inner][sample].ravel())
+        if escale>0:
+            v = window-pfilters.gaussian_filter(window, escale*20.0)
+            v = pfilters.gaussian_filter(v**2, escale*20.0)**0.5
+            vglobal = max(vglobal, np.amax(v[inner]))
+            # binary dilation with an escale*50 box is a maximum filter
+            v = pfilters.maximum_filter(v, int(escale*50))
+            vmaxes.append(v[inner][sample].ravel())
+    values = np.concatenate(values)
+    if escale>0:
+        values = values[np.concatenate(vmaxes)>0.3*vglobal]
+    lo = stats.scoreatpercentile(values, lo)
+    hi = stats.scoreatpercentile(values, hi)
+
+    # rescale and threshold, writing the outputs strip by strip
+    normalized = memmap("nrm", 'B')
+    binary = memmap("bin", 'B')
+    for y in np.arange(0, h, tilesize):
+        strip = (np.array(flat[y:y+tilesize], 'd')-lo)/(hi-lo)
+        strip = np.clip(strip, 0, 1)
+        normalized[y:y+tilesize] = np.array(255*strip, 'B')
+        binary[y:y+tilesize] = 255*(strip>threshold)
+    normalized.flush()
+    binary.flush()
+    return binary, normalized, angle, lo, hi
@@ -0,0 +1,159 @@
+################################################################
+### Page-level filters on several threads.
+###
+### The scipy.ndimage filters run on one core, and on a full page
+### they are most of the cost of binarization and page segmentation.
+### The functions here have the same arguments as the scipy filters
+### of the same name, but split the image into strips (with a halo of
+### as many rows or columns as the filter reaches), filter the strips
+### on a pool of threads (scipy releases the GIL while it filters) and
+### stitch the results together:
+###
+###     from ocrolib import pfilters
+###     smoothed = pfilters.gaussian_filter(image, (scale, 0.5*scale))
+###
+### The strips run across the axis along which the filter reaches
+### least, so a filter of size 1 along an axis is split along that axis
+### without any halo.  The results are the same as those of the scipy
+### filters, except that uniform_filter, which keeps running sums, may
+### differ in the last bits when it has to be split along an axis of
+### size greater than 1.  Small images are filtered directly.
+###
+### The number of threads is the number of processors, or
+### $OCROPUS_THREADS; set_threads changes it (ocrolib.imap_jobs divides
+### the processors among its worker processes this way).
+################################################################
+
+from __future__ import print_function
+
+import math
+import multiprocessing
+import multiprocessing.pool
+import os
+
+import numpy as np
+from scipy.ndimage import filters
+
+# images with fewer pixels than this are not split
+min_pixels = 1<<20
+
+# strips are at least this many rows (or columns) high, and at least
+# four times the halo
+min_strip = 64
+
+threads = int(os.environ.get("OCROPUS_THREADS", 0)) or multiprocessing.cpu_count()
+
+_pool = None
+_pool_key = None
+
+
+def set_threads(n):
+    """Set the number of threads used for filtering; 1 filters directly."""
+    global threads
+    threads = max(1, int(n))
+
+
+def _get_pool():
+    # a pool inherited through fork has no threads behind it
+    global _pool, _pool_key
+    key = (os.getpid(), threads)
+    if _pool_key!=key:
+        if _pool is not None and _pool_key[0]==key[0]:
+            _pool.close()
+        _pool = multiprocessing.pool.ThreadPool(threads)
+        _pool_key = key
+    return _pool
+
+
+def _sequence(value, ndim):
+    if np.isscalar(value):
+        return [value]*ndim
+    value = list(value)
+    assert len(value)==ndim, "expected %d values, got %s" % (ndim, value)
+    return value
+
+
+def _window_reach(size, origin):
+    """The reach of running filters over windows of `size` pixels."""
+    size = int(math.ceil(size))
+    if size<=1:
+        return abs(int(origin))
+    return size//2+abs(int(origin))+1
+
+
+def _strips(n, reach):
+    """The number of strips to cut n rows into."""
+    height = max(min_strip, 4*reach)
+    return max(1, min(threads, n//height))
+
+
+def map_strips(f, image, reach):
+    """Apply `f`, a function from arrays to arrays of the same shape, to
+    strips of the 2D `image` and return the stitched result.  `reach` gives,
+    for each axis, how many pixels away from an output pixel `f` looks; the
+    strips are cut across the axis with the smaller reach and extended by
+    that many pixels on either side."""
+    image = np.asarray(image)
+    if threads<2 or image.ndim!=2 or image.size<min_pixels:
+        return f(image)
+    axis = 0 if reach[0]<=reach[1] else 1
+    halo = reach[axis]
+    n = image.shape[axis]
+    k = _strips(n, halo)
+    if k<2:
+        return f(image)
+    bounds = [(i*n//k, (i+1)*n//k) for i in range(k)]
+
+    def strip(i):
+        r0, r1 = bounds[i]
+        a0, a1 = max(0, r0-halo), min(n, r1+halo)
+        index = [slice(None), slice(None)]
+        index[axis] = slice(a0, a1)
+        result = f(image[tuple(index)])
+        index[axis] = slice(r0-a0, r1-a0)
+        return result[tuple(index)]
+
+    results = _get_pool().map(strip, range(k))
+    return np.concatenate(results, axis=axis)
+
+
+def gaussian_filter(input, sigma, order=0, mode="reflect", cval=0.0, truncate=4.0):
+    """scipy.ndimage.gaussian_filter, split into strips."""
+    sigmas = _sequence(sigma, np.ndim(input))
+    reach = [int(truncate*float(s)+0.5) for s in sigmas]
+    return map_strips(lambda a: filters.gaussian_filter(a, sigma, order=order, mode=mode,
+                                                        cval=cval, truncate=truncate),
+                      input, reach)
+
+
+def uniform_filter(input, size=3, mode="reflect", cval=0.0, origin=0):
+    """scipy.ndimage.uniform_filter, split into strips."""
+    ndim = np.ndim(input)
+    reach = [_window_reach(s, o) for s, o in zip(_sequence(size, ndim), _sequence(origin, ndim))]
+    return map_strips(lambda a: filters.uniform_filter(a, size, mode=mode, cval=cval, origin=origin),
+                      input, reach)
+
+
+def maximum_filter(input, size, mode="reflect", cval=0.0, origin=0):
+    """scipy.ndimage.maximum_filter with a rectangle, split into strips."""
+    ndim = np.ndim(input)
+    reach = [_window_reach(s, o) for s, o in zip(_sequence(size, ndim), _sequence(origin, ndim))]
+    return map_strips(lambda a: filters.maximum_filter(a, size, mode=mode, cval=cval, origin=origin),
+                      input, reach)
+
+
+def minimum_filter(input, size, mode="reflect", cval=0.0, origin=0):
+    """scipy.ndimage.minimum_filter with a rectangle, split into strips."""
+    ndim = np.ndim(input)
+    reach = [_window_reach(s, o) for s, o in zip(_sequence(size, ndim), _sequence(origin, ndim))]
+    return map_strips(lambda a: filters.minimum_filter(a, size, mode=mode, cval=cval, origin=origin),
+                      input, reach)
+
+
+def percentile_filter(input, percentile, size, mode="reflect", cval=0.0, origin=0):
+    """scipy.ndimage.percentile_filter with a rectangle, split into strips."""
+    ndim = np.ndim(input)
+    reach = [_window_reach(s, o) for s, o in zip(_sequence(size, ndim), _sequence(origin, ndim))]
+    return map_strips(lambda a: filters.percentile_filter(a, percentile, size=size, mode=mode,
+                                                          cval=cval, origin=origin),
+                      input, reach)
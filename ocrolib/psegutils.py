@@ -1,7 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from scipy.ndimage import filters,interpolation
 
 from toplevel import *
 import sl, morph
@@ -43,28 +42,58 @@ def binary_objects(binary):
     return objects
 
 
-def estimate_scale(binary):
-    objects = binary_objects(binary)
-    bysize = sorted(objects,key=sl.area)
-    scalemap = np.zeros(binary.shape)
-    for o in bysize:
-        if np.amax(scalemap[o])>0: continue
-        scalemap[o] = sl.area(o)**0.5
-    scale = np.median(scalemap[(scalemap>3)&(scalemap<100)])
+def box_coverage(shape, rasters):
+    """Count for every pixel of an image of the given shape how many of the boxes (an
+        n x 4 array of (row0,row1,col0,col1)) contain it.  The corners of the boxes are
+        entered into a difference array, which is then summed along both axes."""
+    counts = np.zeros((shape[0]+1,shape[1]+1),'i')
+    r0,r1,c0,c1 = rasters.T
+    np.add.at(counts,(r0,c0),1)
+    np.add.at(counts,(r0,c1),-1)
+    np.add.at(counts,(r1,c0),-1)
+    np.add.at(counts,(r1,c1),1)
+    return np.cumsum(np.cumsum(counts,axis=0,dtype='i'),axis=1,dtype='i')[:-1,:-1]
+
+
+def estimate_scale(binary, components=None):
+    """Estimate the scale (roughly, the xheight) of a page as the median square root of
+        the bounding box areas of the components, weighted by area.  Going from the smallest
+        to the largest box, boxes that overlap an already counted box are skipped.
+        `components` is the morph.ComponentIndex of `binary`, if it is already known.
+    """
+    if components is None:
+        components = morph.ComponentIndex(binary)
+    rasters = components.rasters()
+    r0,r1,c0,c1 = rasters.T
+    areas = components.boxareas()
+    # boxes that overlap no other box are always counted; only the others
+    # need to be checked one by one (those are usually few)
+    overlaps = np.zeros((binary.shape[0]+1,binary.shape[1]+1),'i')
+    overlaps[1:,1:] = box_coverage(binary.shape,rasters)>1
+    overlaps = np.cumsum(np.cumsum(overlaps,axis=0,dtype='i'),axis=1,dtype='i')
+    counted = (overlaps[r1,c1]-overlaps[r0,c1]-overlaps[r1,c0]+overlaps[r0,c0]==0)
+    occupied = np.zeros(binary.shape,'B')
+    for i in np.argsort(areas,kind='mergesort'):
+        if counted[i]: continue
+        o = sl.box(*rasters[i])
+        if np.amax(occupied[o])>0: continue
+        occupied[o] = 1
+        counted[i] = 1
+    sizes = areas[counted]**0.5
+    keep = (sizes>3)&(sizes<100)
+    scale = np.median(np.repeat(sizes[keep],areas[counted][keep]))
     return scale
 
 
-def compute_boxmap(binary, scale, threshold=(.5, 4), dtype='i'):
-    objects = binary_objects(binary)
-    bysize = sorted(objects, key=sl.area)
-    boxmap = np.zeros(binary.shape, dtype)
-    for o in bysize:
-        if sl.area(o)**.5 < threshold[0]*scale:
-            continue
-        if sl.area(o)**.5 > threshold[1]*scale:
-            continue
-        boxmap[o] = 1
-    return boxmap
+def compute_boxmap(binary, scale, threshold=(.5, 4), dtype='i', components=None):
+    """Mark the bounding boxes of the components whose size (the square root of the box
+        area) is between threshold[0]*scale and threshold[1]*scale.  `components` is the
+        morph.ComponentIndex of `binary`, if it is already known."""
+    if components is None:
+        components = morph.ComponentIndex(binary)
+    sizes = components.boxareas()**.5
+    rasters = components.rasters()[(sizes>=threshold[0]*scale)&(sizes<=threshold[1]*scale)]
+    return np.array(box_coverage(binary.shape,rasters)>0,dtype)
 
 
 def compute_lines(segmentation, scale):
@@ -92,28 +121,75 @@ def pad_image(image,d,cval=np.inf):
     return result
 
 
+def _window(start, size, n, nearest):
+    """For the range [start,start+size) of an axis of length n, find the part
+    [lo,hi) that lies inside the axis and the offset at which it goes in the
+    window.  With `nearest`, a range entirely outside the axis gets the closest
+    row or column instead."""
+    lo, hi = max(start, 0), min(start+size, n)
+    if hi<=lo and nearest:
+        lo = min(max(start, 0), n-1)
+        hi = lo+1
+    return lo, hi, lo-start
+
+
+def _crop(image, y0, x0, ch, cw, nearest, cval):
+    """Cut the window of size (ch,cw) at (y0,x0) out of the image, extending
+    the image by repeating its border (`nearest`) or by `cval`."""
+    h, w = image.shape
+    result = np.empty((ch, cw), image.dtype)
+    ylo, yhi, oy = _window(y0, ch, h, nearest)
+    xlo, xhi, ox = _window(x0, cw, w, nearest)
+    if yhi<=ylo or xhi<=xlo:
+        result[:, :] = cval
+        return result
+    oy, ox = min(max(oy, 0), ch-1), min(max(ox, 0), cw-1)
+    ey, ex = min(oy+yhi-ylo, ch), min(ox+xhi-xlo, cw)
+    result[oy:ey, ox:ex] = image[ylo:ylo+ey-oy, xlo:xlo+ex-ox]
+    if nearest:
+        result[oy:ey, :ox] = result[oy:ey, ox:ox+1]
+        result[oy:ey, ex:] = result[oy:ey, ex-1:ex]
+        result[:oy] = result[oy]
+        result[ey:] = result[ey-1]
+    else:
+        result[oy:ey, :ox] = cval
+        result[oy:ey, ex:] = cval
+        result[:oy] = cval
+        result[ey:] = cval
+    return result
+
+
 @checks(ARANK(2),int,int,int,int,mode=str,cval=True,_=GRAYSCALE)
 def extract(image, y0, x0, y1, x1, mode='nearest', cval=0):
+    """Extract the subimage image[y0:y1,x0:x1], where the bounds may lie
+    outside the image; the image is extended by repeating its border
+    (mode='nearest') or by `cval` (mode='constant').  The result has the
+    dtype of the image.  A subimage larger than the image in either direction
+    gets the image at its top left and is filled up with 1."""
+    assert mode in ('nearest', 'constant'), mode
+    nearest = (mode=='nearest')
     h, w = image.shape
-    ch, cw = y1-y0,x1-x0
-    y, x = np.clip(y0,0,max(h-ch,0)), np.clip(x0,0,max(w-cw, 0))
-    sub = image[y:y+ch, x:x+cw]
-    # print("extract", image.dtype, image.shape)
-    try:
-        r = interpolation.shift(sub, (y-y0,x-x0), mode=mode, cval=cval, order=0)
-        if cw > w or ch > h:
-            pady0, padx0 = max(-y0, 0), max(-x0, 0)
-            r = interpolation.affine_transform(r, np.eye(2), offset=(pady0, padx0), cval=1,
-                        output_shape=(ch, cw))
-        return r
-
-    except RuntimeError:
-        # workaround for platform differences between 32bit and 64bit scipy.ndimage
-        dtype = sub.dtype
-        sub = np.array(sub, dtype='float64')
-        sub = interpolation.shift(sub, (y-y0,x-x0), mode=mode, cval=cval, order=0)
-        sub = np.array(sub, dtype=dtype)
-        return sub
+    ch, cw = y1-y0, x1-x0
+    if ch<=h and cw<=w:
+        return _crop(image, y0, x0, ch, cw, nearest, cval)
+    py, px = max(-y0, 0), max(-x0, 0)
+    lh, lw = min(ch, h)-py, min(cw, w)-px
+    result = np.ones((ch, cw), image.dtype)
+    if lh>0 and lw>0:
+        result[:lh, :lw] = _crop(image, y0+py, x0+px, lh, lw, nearest, cval)
+    return result
+
+
+def _dilate_mask(mask, size):
+    """Dilate a boolean mask with a size x size box, placed like that of
+    maximum_filter, by or-ing shifted slices."""
+    for axis in (0, 1):
+        source, mask = mask, mask.copy()
+        view, sview = np.swapaxes(mask, 0, axis), np.swapaxes(source, 0, axis)
+        for d in range(-(size//2), size-size//2):
+            if d>0: view[:-d] |= sview[d:]
+            elif d<0: view[-d:] |= sview[:d]
+    return mask
 
 
 @checks(ARANK(2),True,pad=int,expand=int,_=GRAYSCALE)
@@ -123,21 +199,81 @@ def extract_masked(image, linedesc, pad=5, expand=0):
     """
     y0, x0, y1, x1 = [int(x) for x in [linedesc.bounds[0].start, linedesc.bounds[1].start,
                                        linedesc.bounds[0].stop, linedesc.bounds[1].stop]]
-    if pad>0:
-        mask = pad_image(linedesc.mask,pad,cval=0)
-    else:
-        mask = linedesc.mask
     line = extract(image, y0-pad, x0-pad, y1+pad, x1+pad)
+    mask = np.zeros(line.shape, bool)
+    mh, mw = linedesc.mask.shape
+    mask[pad:pad+mh, pad:pad+mw] = linedesc.mask
     if expand>0:
-        mask = filters.maximum_filter(mask, (expand, expand))
-    line = np.where(mask, line, np.amax(line))
+        mask = _dilate_mask(mask, expand)
+    line[~mask] = np.amax(line)
     return line
 
 
+class RangeMax:
+    """Maxima over ranges of `n` values that only grow, all `fill` initially:
+        `raise_to(lo, hi, value)` raises values[lo:hi+1] to at least `value`, and `query(lo, hi)`
+        computes the maxima of values[lo[k]:hi[k]+1] for arrays of (inclusive) bounds.  This is a
+        sparse table (row k holds the maxima of the runs of 2**k values) that is raised in place,
+        which takes one slice per row, rather than being rebuilt."""
+    def __init__(self, n, fill, dtype='i'):
+        levels = 1
+        while 2**levels<=n: levels += 1
+        self.table = np.full((levels, n), fill, dtype)
+    def raise_to(self, lo, hi, value):
+        for k, row in enumerate(self.table):
+            run = row[max(0, lo-2**k+1):hi+1]
+            np.maximum(run, value, out=run)
+    def query(self, lo, hi):
+        k = np.log2(hi-lo+1).astype('i')
+        return np.maximum(self.table[k, lo], self.table[k, hi-2**k+1])
+
 def reading_order(lines, highlight=None, debug=0):
     """Given the list of lines (a list of 2D slices), computes the partial reading order.  The
         output is a binary 2D array such that order[i, j] is true if line i comes before line j
         in reading order.
+
+        Line i comes before line j if they overlap horizontally and i starts above j, or if i
+        is to the left of j and no line w spans the gap between them (w starts left of the end
+        of i and ends right of the start of j) within the rows covered by the two.  Rather than
+        testing every line w for every pair, the lines are swept by their right edges; the lines
+        that start before the current right edge are entered into a RangeMax holding, for each
+        row, the rightmost end of those lines, and the separator test becomes a range maximum.
+    """
+    if highlight is not None:
+        return reading_order_pairwise(lines, highlight, debug)
+    n = len(lines)
+    order = np.zeros((n,n),'B')
+    if n==0: return order
+    y0 = np.array([u[0].start for u in lines])
+    y1 = np.array([u[0].stop for u in lines])
+    x0 = np.array([u[1].start for u in lines])
+    x1 = np.array([u[1].stop for u in lines])
+    # lines overlapping horizontally are ordered from top to bottom
+    overlaps = (x0[:,np.newaxis]<x1[np.newaxis,:])&(x1[:,np.newaxis]>x0[np.newaxis,:])
+    order[overlaps&(y0[:,np.newaxis]<y0[np.newaxis,:])] = 1
+    # rows are only compared with line boundaries, so they can be renumbered
+    rows = np.unique(np.concatenate([y0,y1]))
+    r0, r1 = np.searchsorted(rows,y0), np.searchsorted(rows,y1)
+    rightmost = RangeMax(len(rows),np.amin(x0)-1,x1.dtype)
+    entered = np.argsort(x0,kind='mergesort')
+    k = 0
+    for i in np.argsort(x1,kind='mergesort'):
+        while k<n and x0[entered[k]]<x1[i]:
+            w = entered[k]
+            rightmost.raise_to(r0[w],r1[w],x1[w])
+            k += 1
+        right, = np.nonzero(x1[i]<x0)
+        if len(right)==0: continue
+        lo = np.minimum(r0[i],r0[right])
+        hi = np.maximum(r1[i],r1[right])
+        separated = rightmost.query(lo,hi)>x0[right]
+        order[i,right[~separated]] = 1
+    return order
+
+def reading_order_pairwise(lines, highlight=None, debug=0):
+    """Reference implementation of reading_order, comparing all pairs of lines
+        (and all lines that could separate them).  This takes O(n^3) time; it is
+        kept for debugging (`highlight`) and for checking reading_order.
     """
     order = np.zeros((len(lines),len(lines)),'B')
     def x_overlaps(u,v):
@@ -177,23 +313,28 @@ def reading_order(lines, highlight=None, debug=0):
 
 def topsort(order):
     """Given a binary array defining a partial order (o[i,j]==True means i<j), compute a topological
-        sort.  This is a quick and dirty implementation that works for up to a few thousand elements.
+        sort.  The depth first search is iterative, so there is no limit on the number of elements.
     """
     n = len(order)
     visited = np.zeros(n)
     L = []
     print("$$ topsort: n=%d order=%s" % (n, desc(order)))
 
-    def visit(k):
+    for k in range(n):
         if visited[k]:
-            return
+            continue
         visited[k] = 1
-        for l in find(order[:, k]):
-            visit(l)
-        L.append(k)
-
-    for k in range(n):
-        visit(k)
+        stack = [(k, iter(find(order[:, k])))]
+        while stack:
+            node, predecessors = stack[-1]
+            for l in predecessors:
+                if not visited[l]:
+                    visited[l] = 1
+                    stack.append((l, iter(find(order[:, l]))))
+                    break
+            else:
+                stack.pop()
+                L.append(node)
     return L #[::-1]
 
 
@@ -0,0 +1,90 @@
+################################################################
+### Text line recognition with a trained RNN model (the core of
+### ocropus-rpred).
+###
+###     network = rpred.load_network("en-default.pyrnn.gz")
+###     text = rpred.recognize_line(network, line)
+################################################################
+
+from __future__ import print_function
+
+import numpy as np
+from scipy.ndimage import measurements
+
+import common, lstm
+from ocrolib.exceptions import BadImage
+
+
+def check_line(image):
+    """Check whether the (inverted) image looks like a text line image.
+    Returns None if it does and an explanation otherwise."""
+    if len(image.shape)==3: return "input image is color image %s"%(image.shape,)
+    if np.mean(image)<np.median(image): return "image may be inverted"
+    h,w = image.shape
+    if h<20: return "image not tall enough for a text line %s"%(image.shape,)
+    if h>200: return "image too tall for a text line %s"%(image.shape,)
+    if w<1.5*h: return "line too short %s"%(image.shape,)
+    if w>4000: return "line too long %s"%(image.shape,)
+    ratio = w*1.0/h
+    _, ncomps = measurements.label(image>np.mean(image))
+    lo = int(0.5*ratio+0.5)
+    hi = int(4*ratio)+1
+    if ncomps<lo: return "too few connected components (got %d, wanted >=%d)"%(ncomps,lo)
+    if ncomps>hi*ratio: return "too many connected components (got %d, wanted <=%d)"%(ncomps,hi)
+    return None
+
+
+def load_network(model, height=-1, verbose=0):
+    """Load a recognition model and prepare it for recognition.  A positive
+    `height` overrides the line height of the model's line normalizer.
+    Raises FileNotFound if the model cannot be found."""
+    network = common.load_object(model, verbose=verbose)
+    for x in network.walk(): x.postLoad()
+    for x in network.walk():
+        if isinstance(x, lstm.LSTM):
+            x.allocate(5000)
+    if height>0:
+        network.lnorm.setHeight(height)
+    return network
+
+
+def prepare_line(network, line, pad=16, lineest=True):
+    """Turn a grayscale line image (dark text on a light background) into the
+    input sequence for the network: dewarp and normalize it with the network's
+    line normalizer (unless `lineest` is false), then invert, transpose and pad it."""
+    if lineest:
+        temp = np.amax(line)-line
+        temp = temp*1.0/np.amax(temp)
+        m = network.lnorm.estimate(temp)
+        line = network.lnorm.normalize(line,cval=np.amax(line),measurement=m)
+    return lstm.prepare_line(line, pad)
+
+
+def recognize_line(network, line, pad=16, lineest=True, normalize=True, check=True):
+    """Recognize a grayscale line image and return the text.  Returns None for
+    empty or blank images.  Raises BadImage if (with `check`) the image does not
+    look like a text line."""
+    if np.prod(line.shape)==0: return None
+    if np.amax(line)==np.amin(line): return None
+    if check:
+        problem = check_line(np.amax(line)-line)
+        if problem is not None:
+            raise BadImage(problem)
+    pred = network.predictString(prepare_line(network, line, pad, lineest))
+    if normalize:
+        pred = common.normalize_text(pred)
+    return pred
+
+
+def character_positions(network, width, pad=16):
+    """The characters recognized in the last line, with their x positions in
+    the line image (of the given width) as (char, x) pairs."""
+    scale = width*1.0/(len(network.outputs)-2*pad)
+    return [(network.l2s([c]), (r-pad)*scale)
+            for r, c in lstm.translate_back(network.outputs, pos=1)]
+
+
+def character_probabilities(network):
+    """The characters recognized in the last line, with their probabilities
+    as (char, p) pairs."""
+    return [(network.l2s([c]), p) for c, p in lstm.translate_back(network.outputs, pos=2)]
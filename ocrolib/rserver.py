@@ -0,0 +1,381 @@
+################################################################
+### A line recognition server (the core of ocropus-rserver).
+###
+### Starting ocropus-rpred costs several seconds (Python, matplotlib,
+### unpickling the model and allocating its buffers) before the first
+### line is recognized, which dominates when only a few lines are
+### recognized at a time.  The server loads its models once and
+### recognizes lines sent to it over HTTP, on a TCP port or a Unix
+### socket.  Requests are JSON:
+###
+###     POST /recognize
+###     {"model": "en-default.pyrnn.gz",
+###      "lines": ["book/0001/010001.bin.png",
+###                "book/0002.lines.npz[010003]",
+###                "book/0003.lines.npz",
+###                {"image": "<base64 PNG data>"}],
+###      "llocs": true, "probabilities": false}
+###
+### Lines are given as file names (read by the server), as lines of
+### line bundles or whole line bundles (see ocrolib.linebundle), or as
+### image data.  The answer has one result per line:
+###
+###     {"results": [{"name": "book/0001/010001.bin.png", "text": "...",
+###                   "llocs": [["T", 3.5], ...]},
+###                  {"name": "...", "error": "image too tall ..."}, ...]}
+###
+### "model" defaults to the first model of the server; GET /models lists
+### the models and the number of lines and batches each has run.
+###
+### Each model is run by a thread of its own, which takes all the lines
+### waiting for it whenever it gets to run, so concurrent requests are
+### served together, in the order in which they arrived; the images are
+### read and decoded by the threads serving the connections, while the
+### model runs.  A Client talks to a server from Python:
+###
+###     client = rserver.Client("localhost:8765")
+###     for result in client.recognize(["book/0001/010001.bin.png", image]):
+###         print(result["text"])
+################################################################
+
+from __future__ import print_function
+
+import base64
+import io
+import json
+import os
+import socket
+import threading
+import traceback
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    import http.client as httplib
+    from queue import Queue, Empty
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    import httplib
+    from Queue import Queue, Empty
+
+import numpy as np
+import PIL.Image
+
+import common, rpred, linebundle
+from ocrolib.exceptions import BadImage, BadInput
+
+default_port = 8765
+
+
+class Job:
+    """Lines waiting to be recognized, and their results once they are."""
+    def __init__(self, lines, llocs=False, probabilities=False):
+        self.lines = lines
+        self.llocs = llocs
+        self.probabilities = probabilities
+        self.results = None
+        self.done = threading.Event()
+
+
+class Recognizer:
+    """A loaded model and the thread that runs it.  The arguments after
+    `network` are those of rpred.recognize_line."""
+    def __init__(self, name, network, pad=16, lineest=True, normalize=True, check=True):
+        self.name = name
+        self.network = network
+        self.pad = pad
+        self.lineest = lineest
+        self.normalize = normalize
+        self.check = check
+        self.nlines = 0
+        self.nbatches = 0
+        self.queue = Queue()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def recognize(self, lines, llocs=False, probabilities=False):
+        """Recognize a list of grayscale line images (dark text on a light
+        background) and return a result dict for each; this waits until the
+        thread of the recognizer gets to them."""
+        job = Job(lines, llocs, probabilities)
+        self.queue.put(job)
+        job.done.wait()
+        return job.results
+
+    def close(self):
+        """Stop the thread once the lines queued so far are recognized."""
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            # None, from close, ends the thread after this batch
+            jobs = [job for job in batch if job is not None]
+            if jobs:
+                self.nbatches += 1
+            for job in jobs:
+                try:
+                    job.results = [self.recognize1(line, job.llocs, job.probabilities)
+                                   for line in job.lines]
+                finally:
+                    job.done.set()
+                self.nlines += len(job.lines)
+            if len(jobs)<len(batch):
+                return
+
+    def recognize1(self, line, llocs=False, probabilities=False):
+        try:
+            text = rpred.recognize_line(self.network, line, self.pad, self.lineest,
+                                        normalize=self.normalize, check=self.check)
+        except BadImage as e:
+            return dict(error=str(e))
+        except Exception as e:
+            traceback.print_exc()
+            return dict(error="%s: %s" % (type(e).__name__, e))
+        result = dict(text=text)
+        if text is not None and llocs:
+            result["llocs"] = [[c, round(float(x), 1)] for c, x in
+                               rpred.character_positions(self.network, line.shape[1], self.pad)]
+        if text is not None and probabilities:
+            result["probabilities"] = [[c, float(p)] for c, p in
+                                       rpred.character_probabilities(self.network)]
+        return result
+
+
+def decode_image(data):
+    """Read a base64 encoded image file as a grayscale array."""
+    try:
+        pil = PIL.Image.open(io.BytesIO(base64.b64decode(data)))
+        return common.pil2gray(pil)
+    except Exception as e:
+        raise BadInput("cannot decode image: %s" % e)
+
+
+def read_lines(specs):
+    """Turn the "lines" of a request into (name, image) pairs; for lines that
+    cannot be read, the image is the exception instead."""
+    result = []
+    bundles = {}
+    try:
+        for i, spec in enumerate(specs):
+            if isinstance(spec, dict) and "image" in spec:
+                try:
+                    result.append((spec.get("name", "#%d" % i), decode_image(spec["image"])))
+                except BadInput as e:
+                    result.append((spec.get("name", "#%d" % i), e))
+                continue
+            fname = spec.get("file") if isinstance(spec, dict) else spec
+            if not isinstance(fname, (type(u""), str)):
+                raise BadInput("line %d: expected a file name or an image" % i)
+            bundle, id = linebundle.split_name(fname)
+            try:
+                if id is None and not linebundle.is_bundle(fname):
+                    result.append((fname, common.read_image_gray(fname)))
+                    continue
+                if bundle not in bundles:
+                    bundles[bundle] = linebundle.LineBundle(bundle)
+                lines = bundles[bundle]
+                for id in (lines.ids if id is None else [id]):
+                    if id not in lines.index:
+                        raise BadInput("%s has no line %06x" % (bundle, id))
+                    result.append((linebundle.line_name(bundle, id), lines.image(id)))
+            except (IOError, OSError, ValueError, BadInput) as e:
+                result.append((fname, e))
+    finally:
+        for lines in bundles.values():
+            lines.close()
+    return result
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    def address_string(self):
+        # connections over Unix sockets have no address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "local"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, content):
+        data = json.dumps(content).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/")!="/models":
+            return self.reply(404, dict(error="unknown path %s" % self.path))
+        models = [dict(name=r.name, lines=r.nlines, batches=r.nbatches)
+                  for r in self.server.recognizers]
+        self.reply(200, dict(models=models))
+
+    def do_POST(self):
+        if self.path.rstrip("/")!="/recognize":
+            return self.reply(404, dict(error="unknown path %s" % self.path))
+        try:
+            length = int(self.headers.get("Content-Length", -1))
+            if length<0:
+                raise BadInput("missing Content-Length")
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            if not isinstance(request, dict) or not isinstance(request.get("lines"), list):
+                raise BadInput("expected an object with a list of lines")
+            recognizer = self.server.recognizer(request.get("model"))
+            lines = read_lines(request["lines"])
+        except (ValueError, BadInput) as e:
+            return self.reply(400, dict(error=str(e)))
+        images = [image for _, image in lines if isinstance(image, np.ndarray)]
+        recognized = iter(recognizer.recognize(images, llocs=bool(request.get("llocs")),
+                                               probabilities=bool(request.get("probabilities"))))
+        results = []
+        for name, image in lines:
+            result = next(recognized) if isinstance(image, np.ndarray) else dict(error=str(image))
+            result["name"] = name
+            results.append(result)
+        self.reply(200, dict(results=results))
+
+
+class ServerMixin(ThreadingMixIn):
+    """A threading HTTP server for a list of recognizers; `server_class` is
+    the socket server it is mixed into."""
+    daemon_threads = True
+
+    def __init__(self, address, recognizers, quiet=False):
+        self.recognizers = list(recognizers)
+        self.quiet = quiet
+        self.server_class.__init__(self, address, RequestHandler)
+
+    def server_close(self):
+        self.server_class.server_close(self)
+        for r in self.recognizers:
+            r.close()
+
+    def recognizer(self, model=None):
+        """The recognizer for a model, by name or file name; the first one
+        by default."""
+        if model is None:
+            return self.recognizers[0]
+        for r in self.recognizers:
+            if model in (r.name, os.path.basename(r.name)):
+                return r
+        raise BadInput("unknown model %s" % model)
+
+
+class TCPServer(ServerMixin, HTTPServer):
+    server_class = HTTPServer
+
+
+class UnixServer(ServerMixin, UnixStreamServer):
+    server_class = UnixStreamServer
+
+
+def is_socket_path(address):
+    return "/" in address and not address.startswith("http:")
+
+
+def make_server(recognizers, address, quiet=False):
+    """Create a server for the given recognizers at `address`, "host:port" or
+    the path of a Unix socket (a stale socket file is removed)."""
+    if is_socket_path(address):
+        if os.path.exists(address):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(address)
+                raise BadInput("%s is in use" % address)
+            except socket.error:
+                os.unlink(address)
+            finally:
+                probe.close()
+        return UnixServer(address, recognizers, quiet)
+    host, port = split_address(address)
+    return TCPServer((host, port), recognizers, quiet)
+
+
+def split_address(address):
+    if address.startswith("http://"):
+        address = address[len("http://"):]
+    address = address.rstrip("/")
+    host, _, port = address.rpartition(":")
+    if host=="":
+        return address or "localhost", default_port
+    return host, int(port)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def encode_image(image):
+    """Encode a grayscale line image (floating point in 0...1, or bytes) as
+    base64 PNG data."""
+    image = np.asarray(image)
+    if image.dtype!=np.dtype('B'):
+        image = np.array(255*np.clip(image, 0.0, 1.0), 'B')
+    stream = io.BytesIO()
+    common.array2pil(image).save(stream, "PNG")
+    return base64.b64encode(stream.getvalue()).decode("ascii")
+
+
+class Client:
+    """A client of a recognition server at `address` (see make_server)."""
+    def __init__(self, address="localhost:%d" % default_port, timeout=None):
+        self.address = address
+        self.timeout = timeout
+
+    def connection(self):
+        if is_socket_path(self.address):
+            return UnixHTTPConnection(self.address, timeout=self.timeout)
+        host, port = split_address(self.address)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def call(self, method, path, content=None):
+        connection = self.connection()
+        try:
+            body = None if content is None else json.dumps(content).encode("utf-8")
+            headers = {} if body is None else {"Content-Type": "application/json"}
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            answer = json.loads(response.read().decode("utf-8"))
+        finally:
+            connection.close()
+        if response.status!=200:
+            raise BadInput("server: %s" % answer.get("error"))
+        return answer
+
+    def models(self):
+        """The models of the server, with their line and batch counts."""
+        return self.call("GET", "/models")["models"]
+
+    def recognize(self, lines, model=None, llocs=False, probabilities=False):
+        """Recognize lines, given as file names (which are made absolute, since
+        the server reads them) or as grayscale images, and return a list of
+        result dicts."""
+        specs = []
+        for line in lines:
+            if isinstance(line, (type(u""), str)):
+                specs.append(os.path.abspath(line))
+            else:
+                specs.append(dict(image=encode_image(line)))
+        request = dict(lines=specs, llocs=llocs, probabilities=probabilities)
+        if model is not None:
+            request["model"] = model
+        return self.call("POST", "/recognize", request)["results"]
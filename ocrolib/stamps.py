@@ -0,0 +1,172 @@
+################################################################
+### Make-style incremental processing.
+###
+### Each ocropus-* tool records, for every output it writes, a stamp
+### with the tool, its version, the parameters, and the content hashes
+### of the inputs.  On a rerun, outputs whose stamp still matches are
+### skipped.  The stamps are kept in one small JSON file per output
+### directory and are only read and written by the main process, so
+### worker processes need not know about them:
+###
+###     stamps = Stamps("nlbin", params)
+###     if not stamps.up_to_date(output, [input]):
+###         ...
+###         stamps.record(output, [input])
+###     stamps.save()
+###
+### The version of a tool is a hash of the running script and of all
+### the modules of the ocrolib package, so that any change to the code a
+### tool runs invalidates its earlier outputs.
+###
+### Input hashes are cached by file size and modification time, so an
+### up-to-date check normally costs a few stat calls; a file that was
+### rewritten with the same contents (e.g., because an earlier stage
+### was rerun) still counts as unchanged.
+################################################################
+
+from __future__ import print_function
+
+import glob
+import hashlib
+import inspect
+import json
+import os
+import sys
+import time
+
+stampfile = ".ocropus-stamps"
+
+
+def file_hash(fname):
+    """Compute the SHA-1 of the contents of a file."""
+    h = hashlib.sha1()
+    with open(fname, "rb") as stream:
+        while True:
+            block = stream.read(1<<20)
+            if not block: break
+            h.update(block)
+    return h.hexdigest()
+
+
+def package_sources():
+    """The source files of the ocrolib package."""
+    return sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "*.py")))
+
+
+def tool_version(sources=()):
+    """Compute a version string for a tool from the source of the running
+    script, the ocrolib package and any other given modules (or file
+    names), so that changes to the code invalidate earlier results."""
+    h = hashlib.sha1()
+    for source in [sys.argv[0]]+package_sources()+list(sources):
+        if not isinstance(source, str):
+            source = inspect.getsourcefile(source)
+        if source is None or not os.path.exists(source): continue
+        h.update(open(source, "rb").read())
+    return h.hexdigest()[:16]
+
+
+def _signature(fname):
+    s = os.stat(fname)
+    return [s.st_size, s.st_mtime]
+
+
+class Stamps:
+    """The stamps of a tool with a given parameter set.  `params` is a dict of
+    parameters that affect the outputs (it must be JSON serializable); `sources`
+    are modules outside of ocrolib whose code the tool depends on.  With `force`, nothing is
+    up to date, but the stamps are still recorded."""
+    def __init__(self, tool, params, sources=(), force=False, autosave=100):
+        self.start = time.time()
+        self.tool = tool
+        self.params = json.loads(json.dumps(params, sort_keys=True))
+        self.version = tool_version(sources)
+        self.force = force
+        self.dbs = {}
+        self.dirty = set()
+        self.hashes = {}
+        self.autosave = autosave
+        self.unsaved = 0
+
+    def db(self, dirname):
+        dirname = os.path.abspath(dirname)
+        if dirname not in self.dbs:
+            try:
+                with open(os.path.join(dirname, stampfile)) as stream:
+                    self.dbs[dirname] = json.load(stream)
+            except (IOError, OSError, ValueError):
+                self.dbs[dirname] = {}
+        return dirname, self.dbs[dirname]
+
+    def hash(self, fname, signature, recorded=None):
+        """Hash a file, reusing the recorded hash if the size and
+        modification time are unchanged."""
+        if recorded is not None and recorded[:2]==signature:
+            return recorded[2]
+        key = (os.path.abspath(fname), tuple(signature))
+        if key not in self.hashes:
+            self.hashes[key] = file_hash(fname)
+        return self.hashes[key]
+
+    def up_to_date(self, output, inputs):
+        """Check whether `output` was produced by this tool, version and
+        parameter set from inputs with the current contents, and whether it
+        (and the other outputs recorded with it) still exists unchanged."""
+        if self.force: return False
+        dirname, db = self.db(os.path.dirname(output) or ".")
+        entry = db.get(os.path.basename(output))
+        if entry is None: return False
+        if entry["tool"]!=self.tool or entry["version"]!=self.version: return False
+        if entry["params"]!=self.params: return False
+        for fname, recorded in entry["outputs"].items():
+            fname = os.path.join(dirname, fname)
+            if not os.path.exists(fname) or _signature(fname)!=recorded: return False
+        recorded_inputs = entry["inputs"]
+        if len(recorded_inputs)!=len(inputs): return False
+        refreshed = {}
+        for fname in inputs:
+            key = os.path.relpath(os.path.abspath(fname), dirname)
+            if key not in recorded_inputs or not os.path.exists(fname): return False
+            signature = _signature(fname)
+            h = self.hash(fname, signature, recorded_inputs[key])
+            if h!=recorded_inputs[key][2]: return False
+            refreshed[key] = signature+[h]
+        if refreshed!=recorded_inputs:
+            # same contents, new modification times; avoid rehashing next time
+            entry["inputs"] = refreshed
+            self.dirty.add(dirname)
+        return True
+
+    def record(self, output, inputs, outputs=()):
+        """Record that `output` (and any additional `outputs`) were produced
+        from `inputs`.  Does nothing if `output` does not exist or was not
+        written since the stamps were created, so that it can be called
+        unconditionally after a job that may have failed."""
+        if not os.path.exists(output): return
+        if os.stat(output).st_mtime<self.start-1: return
+        dirname, db = self.db(os.path.dirname(output) or ".")
+        entry = dict(tool=self.tool, version=self.version, params=self.params)
+        entry["inputs"] = {}
+        for fname in inputs:
+            signature = _signature(fname)
+            key = os.path.relpath(os.path.abspath(fname), dirname)
+            entry["inputs"][key] = signature+[self.hash(fname, signature)]
+        entry["outputs"] = {}
+        for fname in [output]+[f for f in outputs if os.path.exists(f)]:
+            key = os.path.relpath(os.path.abspath(fname), dirname)
+            entry["outputs"][key] = _signature(fname)
+        db[os.path.basename(output)] = entry
+        self.dirty.add(dirname)
+        self.unsaved += 1
+        if self.autosave and self.unsaved>=self.autosave:
+            self.save()
+
+    def save(self):
+        """Write the stamp files that have changed."""
+        for dirname in self.dirty:
+            fname = os.path.join(dirname, stampfile)
+            with open(fname+".tmp", "w") as stream:
+                json.dump(self.dbs[dirname], stream, sort_keys=True)
+            os.rename(fname+".tmp", fname)
+        self.dirty = set()
+        self.unsaved = 0
@@ -350,12 +350,11 @@ AFLOAT3 = ALL(ARANK(3),AFLOAT)
 def ABINARY(a):
     if a.ndim==2 and a.dtype==np.dtype(bool): return 1
     if not a.dtype in int_dtypes: return 0
-    import scipy.ndimage.measurements
-    zeros,ones = scipy.ndimage.measurements.sum(1,a,[0,1])
-    if zeros+ones == a.size: return 1
+    # all values are 0 or 1 (or, for bytes, 0 or 255)
+    if a.size==0: return 0
+    if np.amin(a)>=0 and np.amax(a)<=1: return 1
     if a.dtype==np.dtype('B'):
-        zeros,ones = scipy.ndimage.measurements.sum(1,a,[0,255])
-        if zeros+ones == a.size: return 1
+        if not np.any((a!=0)&(a!=255)): return 1
     return 0
 
 ABINARY1 = ALL(ABINARY,ARRAY1)
@@ -11,14 +11,14 @@ import numpy as np
 from glob import glob
 import argparse
 # from matplotlib.pyplot import imread
-from scipy.ndimage import filters, interpolation, morphology, measurements
+from scipy.ndimage import interpolation, morphology, measurements
 # from scipy.ndimage.filters import gaussian_filter, uniform_filter, maximum_filter
 
 from scipy import stats
 from scipy.misc import imsave
 
 import ocrolib
-from ocrolib import hocr, common, psegutils, morph, sl
+from ocrolib import hocr, common, psegutils, morph, sl, gpageseg, pfilters
 from ocrolib.toplevel import *
 
 """
@@ -273,9 +273,9 @@ def processPngFile(outRoot, origFile, fileNum):
         os.mkdir(outputdir)
     lines = [lines[i] for i in lsort]
     ocrolib.write_page_segmentation("%s.pseg.png" % outputdir, segmentation)
-    cleaned = ocrolib.remove_noise(binary, noise)
+    cleaned = 1-ocrolib.remove_noise(binary, noise)
     for i, l in enumerate(lines):
-        binline = psegutils.extract_masked(1-cleaned, l, pad=pad, expand=expand)
+        binline = psegutils.extract_masked(cleaned, l, pad=pad, expand=expand)
         ocrolib.write_image_binary("%s/01%04x.bin.png" % (outputdir, i+1), binline)
         # if args.gray:
         #     grayline = psegutils.extract_masked(
@@ -382,13 +382,13 @@ def compute_gradmaps(binary, scale, hscale=1.0, vscale=1.0, usegauss=False):
     DSAVE("cleaned", cleaned)
     if usegauss:
         # this uses Gaussians
-        grad = filters.gaussian_filter(1.0*cleaned, (vscale*0.3*scale, hscale*6*scale), order=(1, 0))
+        grad = pfilters.gaussian_filter(1.0*cleaned, (vscale*0.3*scale, hscale*6*scale), order=(1, 0))
     else:
         # this uses non-Gaussian oriented filters
-        grad = filters.gaussian_filter(1.0*cleaned,
+        grad = pfilters.gaussian_filter(1.0*cleaned,
                          (max(4, vscale*0.3*scale), hscale*scale),
                          order=(1, 0))
-        grad = filters.uniform_filter(grad, (vscale, hscale*6*scale))
+        grad = pfilters.uniform_filter(grad, (vscale, hscale*6*scale))
     bottom = ocrolib.norm_max((grad < 0)*(-grad))
     top = ocrolib.norm_max((grad > 0)*grad)
     return bottom, top, boxmap
@@ -400,26 +400,14 @@ def compute_line_seeds(binary, bottom, top, colseps, scale, threshold=0.2, vscal
     """
     t = threshold
     vrange = int(vscale*scale)
-    bmarked = filters.maximum_filter(bottom == filters.maximum_filter(bottom, (vrange, 0)), (2, 2))
+    bmarked = pfilters.maximum_filter(bottom == pfilters.maximum_filter(bottom, (vrange, 0)), (2, 2))
     bmarked = bmarked * (bottom > t*np.amax(bottom)*t) * (1-colseps)
-    tmarked = filters.maximum_filter(top == filters.maximum_filter(top, (vrange, 0)), (2, 2))
+    tmarked = pfilters.maximum_filter(top == pfilters.maximum_filter(top, (vrange, 0)), (2, 2))
     tmarked = tmarked*(top > t*np.amax(top)*t/2)*(1-colseps)
-    tmarked = filters.maximum_filter(tmarked, (1, 20))
-    seeds = np.zeros(binary.shape, 'i')
+    tmarked = pfilters.maximum_filter(tmarked, (1, 20))
     delta = max(3, int(scale/2))
-    for x in range(bmarked.shape[1]):
-        transitions = sorted([(y, 1) for y in find(bmarked[:, x])] +
-                             [(y, 0) for y in find(tmarked[:, x])])[::-1]
-        transitions += [(0, 0)]
-        for l in range(len(transitions)-1):
-            y0, s0 = transitions[l]
-            if s0 == 0:
-                continue
-            seeds[y0-delta:y0, x] = 1
-            y1, s1 = transitions[l+1]
-            if s1 == 0 and (y0-y1) < 5*scale:
-                seeds[y1:y0, x] = 1
-    seeds = filters.maximum_filter(seeds, (1, int(1+scale)))
+    seeds = gpageseg.seed_spans(bmarked, tmarked, delta, 5*scale)
+    seeds = pfilters.maximum_filter(seeds, (1, int(1+scale)))
     seeds = seeds*(1-colseps)
     DSAVE("lineseeds", [seeds, 0.3*tmarked+0.7*bmarked, binary])
     seeds, _ = morph.label(seeds)
@@ -429,12 +417,7 @@ def compute_line_seeds(binary, bottom, top, colseps, scale, threshold=0.2, vscal
 ####
 
 def remove_hlines(binary, scale, maxsize=10):
-    labels, _ = morph.label(binary)
-    objects = morph.find_objects(labels)
-    for i, b in enumerate(objects):
-        if sl.width(b) > maxsize * scale:
-            labels[b][labels[b] == i+1] = 0
-    return np.array(labels != 0, 'B')
+    return gpageseg.remove_hlines(binary, scale, maxsize)
 
 
 def find(condition):
@@ -484,19 +467,19 @@ def compute_colseps_conv(binary, scale=1.0, csminheight=10, maxcolseps=3):
     h, w = binary.shape
     # find vertical whitespace by thresholding
     assert np.array_equal(binary, 1.0*binary)
-    smoothed = filters.gaussian_filter(binary, sigma=(scale, scale*0.5))
-    smoothed = filters.uniform_filter(smoothed, size=(5.0*scale, 1))
+    smoothed = pfilters.gaussian_filter(binary, sigma=(scale, scale*0.5))
+    smoothed = pfilters.uniform_filter(smoothed, size=(5.0*scale, 1))
     thresh = smoothed < np.amax(smoothed)*0.1
     DSAVE("1thresh", thresh)
     # find column edges by filtering
-    grad = filters.gaussian_filter(binary, (scale, scale*0.5), order=(0, 1))
-    grad = filters.uniform_filter(grad, (10.0*scale, 1))
+    grad = pfilters.gaussian_filter(binary, (scale, scale*0.5), order=(0, 1))
+    grad = pfilters.uniform_filter(grad, (10.0*scale, 1))
     # grad = abs(grad) # use this for finding both edges
     grad = (grad > 0.5*np.amax(grad))
     DSAVE("2grad", grad)
     # combine edges and whitespace
-    seps = np.minimum(thresh, filters.maximum_filter(grad, (int(scale), int(5*scale))))
-    seps = filters.maximum_filter(seps, (int(2*scale), 1))
+    seps = np.minimum(thresh, pfilters.maximum_filter(grad, (int(scale), int(5*scale))))
+    seps = pfilters.maximum_filter(seps, (int(2*scale), 1))
     DSAVE("3seps", seps)
     # select only the biggest column separators
     seps = morph.select_regions(seps, sl.dim0, min=csminheight*scale, nbest=maxcolseps)
@@ -533,8 +516,8 @@ def estimate_local_whitelevel(image, zoom=0.5, perc=80, size=20):
         size for filters
     """
     m = interpolation.zoom(image, zoom)
-    m = filters.percentile_filter(m, perc, size=(size, 2))
-    m = filters.percentile_filter(m, perc, size=(2, size))
+    m = pfilters.percentile_filter(m, perc, size=(size, 2))
+    m = pfilters.percentile_filter(m, perc, size=(2, size))
     m = interpolation.zoom(m, 1.0/zoom)
     w, h = np.minimum(np.array(image.shape), np.array(m.shape))
     flat = np.clip(image[:w, :h] - m[:w, :h] + 1, 0, 1)
@@ -571,8 +554,8 @@ def estimate_thresholds(flat, bignore=0.1, escale=1.0, lo=5, hi=90):
         # by default, we use only regions that contain significant variance; this makes the
         # percentile-based low and high estimates more reliable
         e = escale
-        v = est - filters.gaussian_filter(est, e*20.0)
-        v = filters.gaussian_filter(v**2, e*20.0)**0.5
+        v = est - pfilters.gaussian_filter(est, e*20.0)
+        v = pfilters.gaussian_filter(v**2, e*20.0)**0.5
         v = v > 0.3*np.amax(v)
         v = morphology.binary_dilation(v, structure=np.ones((int(e*50), 1)))
         v = morphology.binary_dilation(v, structure=np.ones((1, int(e*50))))